@@ -20,6 +20,7 @@ Fusion_HAT_Globals = {
     "APP_VERSION_REG_ADDR_BOOT": 6,
     "BOOT_MODE_BOOT": 9,
     "MIAN_ENTRY_REG_ADDR_BOOT": 10,
+    "IAP_MAX_DATA_LEN_REG_ADDR_BOOT": None, # u16 Big, max payload per write frame, None if not supported
 
     # Application modes
     "FACTORY_APP_MODE": 0,
@@ -31,6 +32,32 @@ Fusion_HAT_Globals = {
 
     # Firmware configuration
     "FIRMWARE_MAX_BYTES": 24 * 1024,  # 24K
+    # copy of the last burned firmware, for page-incremental updates
+    "FIRMWARE_CACHE_DIR": "~/.cache/fusion_hat_iap",
+    # burn only the pages changed since the cached firmware, off by default
+    "IAP_INCREMENTAL": False,
+
+    # I2C transport, "smbus" (32 bytes blocks) or "rdwr" (raw i2c_rdwr transfers)
+    "I2C_TRANSPORT": "smbus",
+
+    # IAP write frame payload, 4 bytes aligned, capped by the i2c transport
+    "IAP_DATA_LEN": 24,
+    # frames sent before collecting their statuses, 1 is stop-and-wait
+    "IAP_WINDOW_SIZE": 1,
+
+    # IAP status polling, seconds
+    "IAP_POLL_FLOOR": 0.0005,
+    "IAP_POLL_CEILING": 0.02,
+    "IAP_ERASE_TIMEOUT": 5,
+    "IAP_WRITE_TIMEOUT": 5,
+    "IAP_VERIFY_TIMEOUT": 5,
+    # attempts per frame, resent for checksum, data and nack errors only
+    "IAP_RETRY_TIMES": 5,
+    # waiting for the boot address after entering the bootloader, seconds
+    "IAP_TRANSITION_TIMEOUT": 5,
+
+    # Dump every IAP frame through logging / Iap.on_debug
+    "IAP_VERBOSE": False,
 }
 
 CONFLICT_SERVICES = [
@@ -5,29 +5,9 @@ import subprocess
 
 from .ui_tools import UiTools
 from .iap import Iap
+from .firmware import FirmwareCache, FirmwareImage, FirmwareRepository, FirmwareManifest, BurnCheckpoint, FIRMWARE_CACHE_DIR, FIRMWARE_DIR
 from .iap import *
 
-# change working directory to script directory
-file_path = os.path.abspath(__file__)
-file_dir = os.path.dirname(file_path)
-os.chdir(file_dir)
-
-firmware_files = []
-FIRMWARE_DIR = "../firmware"
-for root, dirs, files in os.walk(FIRMWARE_DIR):
-    # print(root, dirs, files)
-    for file in files:
-        if file.endswith(".bin"):
-            full_path = os.path.join(root, file)
-            relative_path = os.path.relpath(full_path, FIRMWARE_DIR)
-            firmware_files.append(relative_path)
-firmware_num = len(firmware_files)
-
-# print("Firmware files:")
-# for i in range(firmware_num):
-#     print(f"{i}: {firmware_files[i]}")
-# exit()
-
 UI_WIDTH = 80
 UI_HEIGHT = 15
 
@@ -94,6 +74,10 @@ class IapToolApp:
         self.conflict_services = conflict_services
         self.ui = UiTools(width=UI_WIDTH, height=UI_HEIGHT)
         self.iap = Iap(self.globals)
+        self.firmware_cache = FirmwareCache(self.globals.get("FIRMWARE_CACHE_DIR", FIRMWARE_CACHE_DIR))
+        self.firmware_repo = FirmwareRepository(self.globals.get("FIRMWARE_DIR", FIRMWARE_DIR))
+        self.firmware_manifest = FirmwareManifest(self.globals.get("FIRMWARE_CACHE_DIR", FIRMWARE_CACHE_DIR))
+        self.burn_checkpoint = BurnCheckpoint(self.globals.get("FIRMWARE_CACHE_DIR", FIRMWARE_CACHE_DIR))
 
         self.boot_version = None
         self.app_version = None
@@ -105,10 +89,11 @@ class IapToolApp:
 
     # -----------------------------------------------------------------
     def get_basic_info(self):
-        self.boot_version = self.iap.get_boot_verion()
-        self.app_version = self.iap.get_app_verion()
-        self.factory_version = self.iap.get_factory_verion()
-        self.main_entry = self.iap.get_main_entry()
+        info = self.iap.read_device_info()
+        self.boot_version = info.boot_version
+        self.app_version = info.app_version
+        self.factory_version = info.factory_version
+        self.main_entry = info.main_entry
 
     def display_basic_info(self, location=(UI_WIDTH-24, 9)):
         self.ui.draw(f"Boot Version: {self.boot_version}", location=location)
@@ -117,9 +102,10 @@ class IapToolApp:
         self.ui.draw(f"Main Entry: {self.main_entry}", location=(location[0], location[1]+3))
 
     def display_currnet_mode(self, location=(UI_WIDTH-24, 7)):
-        if self.iap.boot_i2c.is_ready():
+        mode = self.iap.get_mode()
+        if mode == BOOT_MODE:
             self.ui.draw(f" Current Mode: Boot ", color=self.ui.black_on_green, location=location)
-        elif self.iap.app_i2c.is_ready():
+        elif mode == APP_MODE:
             self.ui.draw(f" Current Mode: App ", color=self.ui.black_on_green, location=location)
         else:
             self.ui.draw(f" Disconnected ", color=self.ui.black_on_red, location=location)
@@ -202,6 +188,23 @@ class IapToolApp:
 
         # get basic info
         self.get_basic_info()
+        # firmware list, re-indexed only if the directory changed
+        firmwares = self.firmware_repo.files
+        firmware_files = [x.name for x in firmwares]
+        firmware_num = len(firmware_files)
+        if self.chosen_firmware_index >= firmware_num:
+            self.chosen_firmware_index = 0
+            self.options_offset = 0
+        # metadata, files are only read the first time they are seen
+        firmware_metas = [self.firmware_manifest.get(x.path) for x in firmwares]
+        self.firmware_manifest.save()
+
+        def _draw_version():
+            meta = firmware_metas[self.chosen_firmware_index]
+            version = "unknown"
+            if meta is not None and meta.version is not None:
+                version = ".".join(str(x) for x in meta.version)
+            self.ui.draw(f"v{version}", location=(45, 3), box_width=10, align='right')
 
         # clear screen
         print(f"{self.ui.home}{self.ui.THEME_BGROUND_COLOR}{self.ui.clear}")
@@ -219,6 +222,7 @@ class IapToolApp:
             _files  = firmware_files[self.options_offset:self.options_offset+OPTIONS_LIST_NUM]
             self.ui.draw_options(_files, self.chosen_firmware_index-self.options_offset, location=(2, 2), box_width=35)
             self.ui.draw(f"{self.chosen_firmware_index+1}/{firmware_num}", location=(45, 2), box_width=7, align='right')
+            _draw_version()
         else:
             self.ui.draw("  No firmware found.", location=(5, 3))
             key = self.ui.inkey()
@@ -231,8 +235,7 @@ class IapToolApp:
             elif key.name == 'KEY_DOWN':
                 self.chosen_firmware_index = (self.chosen_firmware_index + 1) % firmware_num
             elif key.name == 'KEY_ENTER':
-                chosen_file = firmware_files[self.chosen_firmware_index]
-                return f"{FIRMWARE_DIR}/{chosen_file}"
+                return firmwares[self.chosen_firmware_index].path
             elif key.name == 'KEY_ESCAPE':
                 exit()
             else:
@@ -247,6 +250,7 @@ class IapToolApp:
                 _files  = firmware_files[self.options_offset:self.options_offset+OPTIONS_LIST_NUM]
             self.ui.draw_options(_files, self.chosen_firmware_index-self.options_offset, location=(2, 2), box_width=35)
             self.ui.draw(f"{self.chosen_firmware_index+1}/{firmware_num}", location=(45, 2), box_width=7, align='right')
+            _draw_version()
 
     #
     def burn_firmware_handler(self, file_path):
@@ -255,10 +259,13 @@ class IapToolApp:
         # draw title
         self.ui.draw_title("burn firmware")
         #
-        file_size = os.path.getsize(file_path)
+        meta = self.firmware_manifest.get(file_path)
+        file_size = meta.size if meta is not None else os.path.getsize(file_path)
         # 
-        _file_str = [f"firmware: {file_path}", ]
+        _file_str = [f"firmware: {os.path.basename(file_path)}", ]
         _file_str += [f"size: {file_size} bytes"]
+        if meta is not None and meta.version is not None:
+            _file_str += [f"version: {'.'.join(str(x) for x in meta.version)}"]
         self.ui.draw(_file_str, location=(2, 2), box_width=50)
         # check file
         if file_size < 1000:
@@ -309,81 +316,91 @@ class IapToolApp:
             elif key.name == 'KEY_ESCAPE':
                 return
 
-        with open(file_path, 'rb') as f:
-            data = f.read()
-        data = list(data)
-
-        progress_perc = 0
-        data_offset = 0
-        data_len = len(data)
+        # known checksum from the manifest, not computed again
+        image = FirmwareImage.from_file(file_path, checksum=meta.checksum if meta is not None else None)
+        data_len = len(image)
         is_ok = False
 
-        # ---- erasing ----
-        self.ui.draw(f"erasing ...", location=(0, self.ui._height-2))
-        _status = self.iap.earse_flash(data_len)
-        if _status is True:
-            self.ui.draw(f"OK", location=(14, self.ui._height-2), color=self.ui.green)
-            time.sleep(1)
-        else:
-            self.ui.draw([
-                    f"error: erase flash failed. ",
-                    "",
-                    " press any key to exit. "
-                    ],
-                    color=self.ui.black_on_red,
-                    location=(15, 5),
-                    box_width=50,
-                    align='center'
-            )
-            self.ui.inkey()
-            return
-
-        # ---- burning ----
-        self.ui.draw(f"burning: ", location=(0, self.ui._height-2))
-        self.ui.draw_progress_bar(progress_perc, location=(9, self.ui._height-2), box_width=25)
-        self.ui.draw(f"{data_offset}/{data_len} ", location=(42, self.ui._height-2))
-
-        while True:
-            if data_offset > data_len - IAP_DATA_LEN:
-                send_data = data[data_offset:]
-            else:
-                send_data = data[data_offset:data_offset+IAP_DATA_LEN]
-            #
-            _status = self.iap.burn_data(self.ui, send_data, data_offset)
-            if _status == IAP_OK:
-                data_offset += IAP_DATA_LEN
-                if data_offset > data_len:
-                    data_offset = data_len 
-            else:
-                is_ok = False
-                break
-            #
-            progress_perc = int((data_offset)*100/data_len)
-            if progress_perc > 100:
-                progress_perc = 100
+        def _on_progress(data_offset, data_len):
+            progress_perc = int(data_offset*100/data_len)
             self.ui.draw_progress_bar(progress_perc, location=(9, self.ui._height-2), box_width=25)
             self.ui.draw(f"{data_offset}/{data_len} ", location=(42, self.ui._height-2))
 
-            #
-            if progress_perc == 100:
-                is_ok = True
-                self.ui.clear_xline(self.ui._height-1)
-                self.ui.clear_xline(self.ui._height)
-                break
-            #
-            time.sleep(0.01)
+        def _on_debug(msg):
+            self.ui.clear_xline(self.ui._height)
+            self.ui.clear_xline(self.ui._height+1)
+            self.ui.draw(msg, location=(0, self.ui._height-1))
+
+        if self.iap.verbose:
+            self.iap.on_debug = _on_debug
+
+        self.iap.negotiate_data_len()
+
+        # ---- resuming, an interrupted burn of the same firmware ----
+        _status = None
+        _on_checkpoint = self.burn_checkpoint.track(image.sha256, _on_progress)
+        offset = self.burn_checkpoint.load(image.sha256)
+        if offset is not None:
+            self.ui.draw(f"resuming: ", location=(0, self.ui._height-2))
+            _status = self.iap.resume_burn(image, offset, on_progress=_on_checkpoint)
+
+        # ---- patching, only pages changed since the last burned firmware ----
+        previous = self.firmware_cache.load()
+        if _status is None and previous is not None and self.globals.get("IAP_INCREMENTAL", False):
+            self.ui.draw(f"patching: ", location=(0, self.ui._height-2))
+            _status = self.iap.burn_incremental(image, previous, on_progress=_on_progress)
+
+        if _status is None:
+            self.firmware_cache.clear()
+            self.burn_checkpoint.clear()
+            # ---- erasing ----
+            self.ui.draw(f"{' '*self.ui._width}", location=(0, self.ui._height-2))
+            self.ui.draw(f"erasing ...", location=(0, self.ui._height-2))
+            _status = self.iap.earse_flash(data_len)
+            if _status is True:
+                self.ui.draw(f"OK", location=(14, self.ui._height-2), color=self.ui.green)
+                time.sleep(1)
+            else:
+                self.ui.draw([
+                        f"error: erase flash failed. ",
+                        "",
+                        " press any key to exit. "
+                        ],
+                        color=self.ui.black_on_red,
+                        location=(15, 5),
+                        box_width=50,
+                        align='center'
+                )
+                self.ui.inkey()
+                return
+
+            # ---- burning ----
+            self.ui.draw(f"burning: ", location=(0, self.ui._height-2))
+            self.ui.draw_progress_bar(0, location=(9, self.ui._height-2), box_width=25)
+            self.ui.draw(f"0/{data_len} ", location=(42, self.ui._height-2))
+
+            _status = self.iap.burn(image, on_progress=_on_checkpoint)
+
+        if _status == IAP_OK:
+            is_ok = True
+            self.ui.clear_xline(self.ui._height-1)
+            self.ui.clear_xline(self.ui._height)
 
         if is_ok:
             # ---- verify ----
             self.ui.draw(f"{' '*self.ui._width}", location=(0, self.ui._height-2))
             self.ui.draw(f"verifying ...", location=(0, self.ui._height-2))
 
-            _status = self.iap.verify_data(data)
+            _status = self.iap.verify_data(image)
             if _status is True:
                 is_ok = True
                 self.ui.draw(f"OK", location=(14, self.ui._height-2), color=self.ui.green)
+                self.firmware_cache.save(image.data)
+                self.burn_checkpoint.clear()
             else:
                 is_ok = False
+                self.firmware_cache.clear()
+                self.burn_checkpoint.clear()
                 self.ui.draw([
                     f"verify failed.  ",
                     "",
@@ -426,13 +443,35 @@ class IapToolApp:
             self.ui.inkey()
             return
 
+    def confirm_update_handler(self, file_path):
+        # ask before burning a firmware the device already runs,
+        # checked in app mode so there is no boot mode round trip
+        meta = self.firmware_manifest.get(file_path)
+        if meta is None:
+            return True
+        info = self.iap.read_device_info()
+        if not firmware_is_current(info, meta.version, meta.checksum, self.firmware_cache.load()):
+            return True
+        return self.ui.draw_ask([
+                f"device already runs version {info.app_version}. ",
+                "",
+                " Would you like to burn it again? [y/n] "
+                ],
+                color=self.ui.black_on_yellow,
+                location=(15, 5),
+                box_width=50,
+                align='center'
+        )
+
     def update_mdoe_handler(self):
+        chosen_file = self.select_firmware_handler()
+        if not self.confirm_update_handler(chosen_file):
+            return
         is_boot_mode = self.iap.check_boot_mode()
         if not is_boot_mode:
             status = self.enter_boot_mode_handler()
             if not status:
                 return
-        chosen_file = self.select_firmware_handler()
         self.burn_firmware_handler(chosen_file)
 
     def restore_firmware_handler(self):
@@ -632,7 +671,7 @@ class IapToolApp:
                     )
                 self.ui.inkey()
             finally:
-                if self.iap.boot_i2c.is_ready():
+                if self.iap.mode.detect() == BOOT_MODE:
                     opt = self.ui.draw_ask([
                         "Would you like to reboot the device ",
                         f"to exit boot mode? [y/n]",
@@ -645,6 +684,7 @@ class IapToolApp:
                     )
                     if opt is True:
                         self.reset_device_handller()
+                self.iap.close()
         print(track_str)
 
 
@@ -0,0 +1,192 @@
+import asyncio
+import weakref
+
+from .iap import *
+from .firmware import FirmwareImage
+
+# =============================================================
+# asyncio wrapper around Iap. Every bus transaction runs in an
+# executor and every wait is an asyncio.sleep, so one event loop
+# can drive many update sessions. Each coroutine takes an optional
+# timeout and can be cancelled between two bus transactions.
+#
+#   aiap = AsyncIap(Iap(globals, bus=1))
+#   await aiap.enter_boot_mode()
+#   await aiap.earse_flash(len(data))
+#   await aiap.burn(data)
+#   await aiap.verify(data)
+#   await aiap.reset()
+
+
+class AsyncIap:
+    # transactions on one bus are serialized, e.g. boards behind one mux.
+    # {loop: {bus: Lock}}, an entry goes away with its event loop
+    _bus_locks = weakref.WeakKeyDictionary()
+
+    def __init__(self, iap, executor=None, lock=None):
+        self.iap = iap
+        self.executor = executor
+        self.lock = lock # shared by the caller, instead of the per bus lock
+
+    @property
+    def globals(self):
+        return self.iap.globals
+
+    def _bus_lock(self):
+        if self.lock is not None:
+            return self.lock
+        # asyncio locks belong to one event loop
+        locks = AsyncIap._bus_locks.setdefault(asyncio.get_running_loop(), {})
+        if self.iap.bus not in locks:
+            locks[self.iap.bus] = asyncio.Lock()
+        return locks[self.iap.bus]
+
+    async def _run(self, func, *args):
+        # one blocking bus call in the executor. The lock is held until the call
+        # has returned, even if the caller is cancelled or times out meanwhile,
+        # so no other session uses the bus in the middle of a transaction
+        loop = asyncio.get_running_loop()
+        lock = self._bus_lock()
+        await lock.acquire()
+        try:
+            future = loop.run_in_executor(self.executor, func, *args)
+        except BaseException:
+            lock.release()
+            raise
+
+        def _done(future):
+            lock.release()
+            if not future.cancelled():
+                future.exception() # retrieved, not logged as never retrieved
+        future.add_done_callback(_done)
+        return await asyncio.shield(future)
+
+    async def _read_status(self, timeout=IAP_TIMEOUT):
+        # poll the status byte on the schedule of Iap.waiter, see BackoffWait
+        loop = asyncio.get_running_loop()
+        waiter = self.iap.waiter if isinstance(self.iap.waiter, Backoff) else BackoffWait()
+        _st = loop.time()
+        for delay in waiter.delays():
+            try:
+                return await self._run(self.iap.boot_i2c._read_byte)
+            except OSError:
+                pass
+            if loop.time() - _st >= timeout:
+                return IAP_NACK_ERR
+            await asyncio.sleep(delay)
+
+    async def _send_frame(self, frame, timeout=IAP_TIMEOUT):
+        loop = asyncio.get_running_loop()
+        _st = loop.time()
+        # a write that failed never reached the device, don't read a stale status
+        try:
+            await self._run(self.iap.boot_i2c._write_block_data, frame[0], frame[1:])
+        except OSError:
+            return IAP_NACK_ERR
+        status = await self._read_status(timeout)
+        self.iap.stats.add_ack(loop.time() - _st)
+        return status
+
+    # ---------------------------------------------------------
+    async def get_mode(self, timeout=None):
+        return await asyncio.wait_for(self._run(self.iap.get_mode), timeout)
+
+    async def read_device_info(self, timeout=None):
+        return await asyncio.wait_for(self._run(self.iap.read_device_info), timeout)
+
+    async def check_boot_mode(self, timeout=None):
+        return await asyncio.wait_for(self._check_boot_mode(), timeout)
+
+    async def _check_boot_mode(self):
+        if not await self._run(self.iap.boot_i2c.is_ready):
+            return False
+        status = await self._send_frame([IAP_CMD_START, IAP_CMD_ACK, 1, IAP_CMD_END])
+        return status == IAP_OK
+
+    async def _boot_ack(self):
+        # transition probe, as Iap._boot_ack, kept out of stats
+        if not await self._run(self.iap.boot_i2c.is_ready):
+            return False
+        await self._run(self.iap.boot_i2c._write_block_data, IAP_CMD_START, [IAP_CMD_ACK, 1, IAP_CMD_END])
+        return await self._read_status(self.iap.transition.ceiling) == IAP_OK
+
+    async def enter_boot_mode(self, timeout=None):
+        return await asyncio.wait_for(self._enter_boot_mode(), timeout)
+
+    async def _enter_boot_mode(self):
+        self.iap.mode.invalidate()
+        app_i2c = self.iap.app_i2c
+        await self._run(app_i2c._write_block_data, ADV_CMD_START, [ADV_CMD_ENTER_BOOT, 1, ADV_CMD_END])
+        await asyncio.sleep(0.1)
+        status = await self._run(app_i2c._read_byte)
+        if status != IAP_OK:
+            return False
+        # wait for device to enter iap mode, i2c change to 0x5d, see TransitionWaiter
+        transition = self.iap.transition
+        timeout = self.globals.get("IAP_TRANSITION_TIMEOUT", TRANSITION_TIMEOUT)
+        loop = asyncio.get_running_loop()
+        _st = loop.time()
+        await asyncio.sleep(transition.headstart(BOOT_MODE))
+        for delay in transition.delays():
+            try:
+                if await self._boot_ack():
+                    transition.record(BOOT_MODE, loop.time() - _st)
+                    return True
+            except OSError:
+                pass
+            if loop.time() - _st >= timeout:
+                return False
+            await asyncio.sleep(delay)
+
+    async def earse_flash(self, file_size, start_page=0, timeout=None):
+        return await asyncio.wait_for(self._earse_flash(file_size, start_page), timeout)
+
+    async def _earse_flash(self, file_size, start_page):
+        frame = self.iap.build_erase_frame(file_size, start_page)
+        status = await self._send_retry(frame, self.iap._timeout("ERASE"))
+        return status == IAP_OK
+
+    async def _send_retry(self, frame, timeout):
+        # resend with backoff while the status is retryable, as RetryPolicy.run
+        retry = self.iap.retry
+        delays = retry.delays()
+        status = None
+        attempts = 0
+        while retry.should_retry(status, attempts):
+            if status is not None:
+                self.iap.stats.add_retry(status)
+                await asyncio.sleep(next(delays))
+            status = await self._send_frame(frame, timeout)
+            attempts += 1
+        return status
+
+    async def burn_data(self, data, data_offset, timeout=None):
+        frame = bytes(self.iap.build_write_frame(data, data_offset))
+        return await asyncio.wait_for(self._send_retry(frame, self.iap._timeout("WRITE")), timeout)
+
+    async def burn(self, data, on_progress=None, timeout=None):
+        return await asyncio.wait_for(self._burn(data, on_progress), timeout)
+
+    async def _burn(self, data, on_progress):
+        # stop-and-wait, frame by frame, return the status of the last frame
+        image = data if isinstance(data, FirmwareImage) else FirmwareImage(data)
+        data_len = len(image)
+        status = IAP_OK
+        for data_offset, frame in self.iap.encode(image).frames:
+            status = await self._send_retry(frame, self.iap._timeout("WRITE"))
+            if status != IAP_OK:
+                break
+            if on_progress is not None:
+                on_progress(min(data_offset + self.iap.data_len, data_len), data_len)
+        return status
+
+    async def verify(self, data, timeout=None):
+        frame = self.iap.build_verify_frame(data)
+        status = await asyncio.wait_for(self._send_retry(frame, self.iap._timeout("VERIFY")), timeout)
+        return status == IAP_OK
+
+    async def restore_factory_firmware(self, timeout=None):
+        return await asyncio.wait_for(self._run(self.iap.restore_factory_firmware), timeout)
+
+    async def reset(self, timeout=None):
+        return await asyncio.wait_for(self._run(self.iap.reset_device), timeout)
@@ -0,0 +1,168 @@
+import sys
+import json
+import math
+import time
+import argparse
+
+from .iap import Iap, IAP_OK
+from .i2c import I2CRdwr
+from .simulator import SimulatedFusionHat
+from .firmware import FirmwareImage
+
+# =============================================================
+# Firmware flashing benchmark
+#
+#   python -m i2c_iap_tool.benchmark firmware/xxx.bin --data-len 24 --output result.json
+#
+# Runs enter boot, erase, burn, verify and reset against the
+# simulator (default) or the real board (--hardware), and reports
+# per phase wall time, frame rate, throughput, retries and ack
+# latency percentiles as JSON.
+
+def percentile(values, perc):
+    # nearest-rank percentile
+    if not values:
+        return None
+    values = sorted(values)
+    index = max(0, min(len(values) - 1, math.ceil(perc/100*len(values)) - 1))
+    return values[index]
+
+
+def run_phase(result, name, func):
+    _st = time.time()
+    value = func()
+    result["phases"][name] = time.time() - _st
+    return value
+
+
+def run_benchmark(iap, data, reset=True):
+    image = FirmwareImage(data)
+    data = image.data
+    result = {
+        "ok": False,
+        "firmware_size": len(data),
+        "data_len": None,
+        "window": iap.globals.get("IAP_WINDOW_SIZE", 1),
+        "phases": {},
+    }
+    iap.stats.reset()
+
+    if not iap.check_boot_mode():
+        if not run_phase(result, "enter_boot", iap.enter_boot_mode):
+            result["error"] = "entering bootloader failed"
+            return result
+    result["data_len"] = iap.negotiate_data_len()
+
+    if not run_phase(result, "erase", lambda: iap.earse_flash(len(data))):
+        result["error"] = "erase flash failed"
+        return result
+
+    frames_before = iap.stats.frames
+    latencies_before = len(iap.stats.ack_latencies)
+    status = run_phase(result, "burn", lambda: iap.burn(image))
+    burn_time = result["phases"]["burn"]
+    burn_frames = iap.stats.frames - frames_before
+    burn_latencies = iap.stats.ack_latencies[latencies_before:]
+    result["frames"] = burn_frames
+    result["frames_per_second"] = burn_frames / burn_time if burn_time > 0 else None
+    result["bytes_per_second"] = len(data) / burn_time if burn_time > 0 else None
+    result["ack_latency"] = {
+        "p50": percentile(burn_latencies, 50),
+        "p90": percentile(burn_latencies, 90),
+        "p99": percentile(burn_latencies, 99),
+        "max": max(burn_latencies) if burn_latencies else None,
+    }
+    if status != IAP_OK:
+        result["error"] = f"burn failed 0x{status:02x}"
+        result["retries"] = iap.stats.retries
+        return result
+
+    if not run_phase(result, "verify", lambda: iap.verify_data(image)):
+        result["error"] = "verify failed"
+        result["retries"] = iap.stats.retries
+        return result
+
+    if reset:
+        run_phase(result, "reset", iap.reset_device)
+
+    result["retries"] = iap.stats.retries
+    result["retry_statuses"] = {f"0x{k:02x}": v for k, v in iap.stats.retry_statuses.items()}
+    result["total"] = sum(result["phases"].values())
+    result["ok"] = True
+    return result
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m i2c_iap_tool.benchmark",
+                                     description="Firmware flashing benchmark")
+    parser.add_argument("file", help="firmware .bin file")
+    parser.add_argument("--hardware", action="store_true", help="use the real board instead of the simulator")
+    parser.add_argument("--transport", choices=["smbus", "rdwr"], default=None, help="i2c transport")
+    parser.add_argument("--data-len", type=int, default=None, help="IAP write frame payload")
+    parser.add_argument("--window", type=int, default=None, help="frames sent before collecting statuses")
+    parser.add_argument("--no-reset", action="store_true", help="skip the reset phase")
+    parser.add_argument("--output", default=None, help="write the JSON result to this file")
+    # simulator
+    parser.add_argument("--bus-speed", type=int, default=100000, help="simulated bus clock, Hz")
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated per transfer latency, s")
+    parser.add_argument("--write-time", type=float, default=0.0, help="simulated busy time per write frame, s")
+    parser.add_argument("--erase-time", type=float, default=0.0, help="simulated busy time per erased page, s")
+    parser.add_argument("--checksum-error-rate", type=float, default=0.0, help="simulated checksum error rate")
+    parser.add_argument("--seed", type=int, default=None, help="simulator random seed")
+    return parser
+
+
+def main(argv=None, globals=None):
+    if globals is None:
+        from globals.fusion_hat_globals import Fusion_HAT_Globals
+        globals = Fusion_HAT_Globals
+    args = build_parser().parse_args(argv)
+
+    globals = dict(globals)
+    if args.transport is not None:
+        globals["I2C_TRANSPORT"] = args.transport
+    if args.data_len is not None:
+        globals["IAP_DATA_LEN"] = args.data_len
+    if args.window is not None:
+        globals["IAP_WINDOW_SIZE"] = args.window
+
+    with open(args.file, 'rb') as f:
+        data = f.read()
+
+    if args.hardware:
+        iap = Iap(globals)
+        transport = {"name": globals.get("I2C_TRANSPORT", "smbus")}
+    else:
+        block_max = None
+        if globals.get("I2C_TRANSPORT", "smbus") == "rdwr":
+            block_max = I2CRdwr.BLOCK_MAX
+        device = SimulatedFusionHat(globals,
+                                    bus_speed=args.bus_speed,
+                                    latency=args.latency,
+                                    write_time=args.write_time,
+                                    erase_time=args.erase_time,
+                                    pipeline_depth=globals.get("IAP_WINDOW_SIZE", 1),
+                                    checksum_error_rate=args.checksum_error_rate,
+                                    seed=args.seed)
+        iap = device.iap(block_max=block_max)
+        transport = {
+            "name": "simulator",
+            "i2c": globals.get("I2C_TRANSPORT", "smbus"),
+            "bus_speed": args.bus_speed,
+            "latency": args.latency,
+        }
+
+    result = run_benchmark(iap, data, reset=not args.no_reset)
+    result["transport"] = transport
+    result["file"] = args.file
+
+    output = json.dumps(result, indent=2)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+    print(output)
+    return 0 if result["ok"] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
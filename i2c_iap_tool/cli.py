@@ -0,0 +1,242 @@
+import sys
+import json
+import errno
+import argparse
+import threading
+
+from .iap import Iap
+from .i2c import I2C, MUX_CHANNELS
+from .firmware import parse_firmware_name
+from .session import flash_image, ensure_boot_mode, ERROR_NO_DEVICE
+from .fleet import discover_buses, flash_buses, discover_mux_channels, flash_mux_channels
+
+# exit codes
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+EXIT_NO_DEVICE = 3
+
+FIRMWARE_MIN_BYTES = 1000
+
+# -----------------------------------------------------------------
+def output(result, as_json=False):
+    if as_json:
+        print(json.dumps(result))
+    else:
+        for key, value in result.items():
+            print(f"{key}: {value}")
+
+class ProgressLine:
+    # burn progress on stderr, so stdout keeps only the result. Rewritten in
+    # place on a terminal, otherwise one line every 10%. Called from the
+    # fleet worker threads too
+    def __init__(self, label, stream=None):
+        self.label = label
+        self.stream = stream or sys.stderr
+        self.in_place = self.stream.isatty()
+        self._lock = threading.Lock()
+        self._last = None
+
+    def __call__(self, done, total):
+        if total <= 0:
+            return
+        perc = done*100 // total
+        step = perc if self.in_place else perc - perc % 10
+        with self._lock:
+            if step == self._last:
+                return
+            self._last = step
+            line = f"{self.label}: {done}/{total} bytes ({perc}%)"
+            self.stream.write(f"\r{line}" if self.in_place else f"{line}\n")
+            self.stream.flush()
+
+    def finish(self):
+        if self.in_place and self._last is not None:
+            self.stream.write("\n")
+            self.stream.flush()
+
+def failed(result, error, code=EXIT_FAILED):
+    result["ok"] = False
+    result["error"] = error
+    return result, code
+
+def exit_code(result):
+    if result["ok"]:
+        return EXIT_OK
+    if result.get("error") == ERROR_NO_DEVICE:
+        return EXIT_NO_DEVICE
+    return EXIT_FAILED
+
+# -----------------------------------------------------------------
+def cmd_info(iap, args):
+    info = iap.read_device_info()
+    result = {"command": "info", "ok": info.mode is not None}
+    result.update(info._asdict())
+    if info.mode is None:
+        return failed(result, ERROR_NO_DEVICE, EXIT_NO_DEVICE)
+    return result, EXIT_OK
+
+def read_firmware(result, file_path, globals):
+    # return the image, or None with the error filled in `result`
+    try:
+        with open(file_path, 'rb') as f:
+            data = f.read()
+    except OSError as e:
+        failed(result, f"cannot read firmware: {e}")
+        return None
+    result["size"] = len(data)
+    if len(data) < FIRMWARE_MIN_BYTES:
+        failed(result, "file size is too small")
+        return None
+    if len(data) > globals["FIRMWARE_MAX_BYTES"]:
+        failed(result, f"file size is too large, max {globals['FIRMWARE_MAX_BYTES']} bytes")
+        return None
+    return data
+
+def cmd_flash(iap, args):
+    # args.data: the firmware, read and checked in main() before the bus is opened
+    result = {"command": "flash", "ok": False, "bus": iap.bus, "file": args.file, "size": len(args.data)}
+    _, version = parse_firmware_name(args.file)
+    result = flash_image(iap, args.data, result, full=args.full, reset=not args.no_reset,
+                         on_progress=args.progress, version=version, force=args.force,
+                         incremental=args.incremental)
+    return result, exit_code(result)
+
+def cmd_flash_all(globals, args):
+    result = {"command": "flash-all", "ok": False, "file": args.file, "size": len(args.data)}
+    data = args.data
+    _, version = parse_firmware_name(args.file)
+    if args.mux is not None:
+        channels = args.channels or discover_mux_channels(globals, args.bus, args.mux)
+        results = flash_mux_channels(globals, args.bus, args.mux, channels, data, reset=not args.no_reset,
+                                     on_progress=args.progress, version=version, force=args.force)
+        result["results"] = results
+        result["ok"] = len(results) > 0 and all(x["ok"] for x in results.values())
+        if not results:
+            return failed(result, ERROR_NO_DEVICE, EXIT_NO_DEVICE)
+        if not result["ok"]:
+            return failed(result, "some devices failed")
+        return result, EXIT_OK
+    buses = args.buses or discover_buses(globals)
+    result["buses"] = buses
+    if not buses:
+        return failed(result, ERROR_NO_DEVICE, EXIT_NO_DEVICE)
+    results = flash_buses(globals, buses, data, workers=args.workers,
+                          full=args.full, reset=not args.no_reset, on_progress=args.progress,
+                          version=version, force=args.force, incremental=args.incremental)
+    result["results"] = results
+    result["ok"] = all(x["ok"] for x in results.values())
+    if not result["ok"]:
+        return failed(result, "some devices failed")
+    return result, EXIT_OK
+
+def cmd_restore_factory(iap, args):
+    result = {"command": "restore-factory", "ok": False}
+    if iap.get_mode() is None:
+        return failed(result, ERROR_NO_DEVICE, EXIT_NO_DEVICE)
+    if not ensure_boot_mode(iap):
+        return failed(result, "entering bootloader failed")
+    if not iap.restore_factory_firmware():
+        return failed(result, "restore factory firmware failed")
+    if not args.no_reset:
+        result["reset"] = iap.reset_device()
+    result["ok"] = True
+    return result, EXIT_OK
+
+def cmd_reset(iap, args):
+    result = {"command": "reset", "ok": False}
+    if iap.get_mode() is None:
+        return failed(result, ERROR_NO_DEVICE, EXIT_NO_DEVICE)
+    if not iap.reset_device():
+        return failed(result, "reset device failed")
+    result["ok"] = True
+    return result, EXIT_OK
+
+# -----------------------------------------------------------------
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m i2c_iap_tool",
+                                     description="Non-interactive firmware update tool")
+    parser.add_argument("--json", action="store_true", help="print machine-readable JSON")
+    parser.add_argument("--bus", type=int, default=1, help="i2c bus number, /dev/i2c-N")
+    parser.add_argument("--mux", type=lambda x: int(x, 0), default=None, help="i2c mux address, e.g. 0x70")
+    parser.add_argument("--channel", type=int, default=None, help="mux channel of the device")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    subparsers.add_parser("info", help="show device mode and versions")
+
+    flash = subparsers.add_parser("flash", help="burn a firmware file")
+    flash.add_argument("file", help="firmware .bin file")
+    flash.add_argument("--full", action="store_true", help="always erase and burn the whole image")
+    flash.add_argument("--incremental", action="store_true", default=None,
+                       help="burn only the pages changed since the last burned firmware")
+    flash.add_argument("--no-reset", action="store_true", help="stay in boot mode after burning")
+    flash.add_argument("--force", action="store_true", help="burn even if the device already runs this version")
+
+    restore = subparsers.add_parser("restore-factory", help="restore the factory firmware")
+    restore.add_argument("--no-reset", action="store_true", help="stay in boot mode after restoring")
+
+    subparsers.add_parser("reset", help="reset the device")
+
+    flash_all = subparsers.add_parser("flash-all", help="burn a firmware file on every bus with a device, in parallel")
+    flash_all.add_argument("file", help="firmware .bin file")
+    flash_all.add_argument("--buses", type=int, nargs="+", default=None, help="i2c buses, default: discover")
+    flash_all.add_argument("--workers", type=int, default=None, help="parallel sessions, default: one per bus")
+    flash_all.add_argument("--channels", type=int, nargs="+", default=None,
+                           help="with --mux, mux channels to flash on --bus, default: all")
+    flash_all.add_argument("--full", action="store_true", help="always erase and burn the whole image")
+    flash_all.add_argument("--incremental", action="store_true", default=None,
+                           help="burn only the pages changed since the last burned firmware")
+    flash_all.add_argument("--no-reset", action="store_true", help="stay in boot mode after burning")
+    flash_all.add_argument("--force", action="store_true", help="burn even if a device already runs this version")
+    return parser
+
+COMMANDS = {
+    "info": cmd_info,
+    "flash": cmd_flash,
+    "restore-factory": cmd_restore_factory,
+    "reset": cmd_reset,
+}
+
+def main(argv=None, globals=None):
+    if globals is None:
+        from globals.fusion_hat_globals import Fusion_HAT_Globals
+        globals = Fusion_HAT_Globals
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.mux is not None and args.channel is None and args.command != "flash-all":
+        parser.error("--mux requires --channel")
+    if args.channel is not None and args.mux is None:
+        parser.error("--channel requires --mux")
+    if args.command == "flash-all":
+        # boards behind a mux are always erased and burned in full, interleaved, without resume
+        if args.mux is not None:
+            for flag in ("full", "incremental", "buses", "workers"):
+                if getattr(args, flag):
+                    parser.error(f"--{flag} does not apply to flash-all with --mux")
+        elif args.channels is not None:
+            parser.error("--channels requires --mux")
+    if args.command in ("flash", "flash-all"):
+        result = {"command": args.command, "ok": False, "file": args.file}
+        args.data = read_firmware(result, args.file, globals)
+        if args.data is None:
+            output(result, args.json)
+            return EXIT_USAGE
+        # summed over every board for flash-all
+        args.progress = None if args.json else ProgressLine(args.command)
+    try:
+        if args.command == "flash-all" and args.mux is None:
+            result, code = cmd_flash_all(globals, args)
+        elif not I2C.enabled(args.bus):
+            result, code = failed({"command": args.command, "bus": args.bus}, ERROR_NO_DEVICE, EXIT_NO_DEVICE)
+        elif args.command == "flash-all":
+            result, code = cmd_flash_all(globals, args)
+        else:
+            with Iap(globals, bus=args.bus, mux_addr=args.mux, mux_channel=args.channel) as iap:
+                result, code = COMMANDS[args.command](iap, args)
+    except OSError as e:
+        code = EXIT_NO_DEVICE if e.errno == errno.ENOENT else EXIT_FAILED
+        result, code = failed({"command": args.command}, f"i2c error: {e}", code)
+    if getattr(args, "progress", None) is not None:
+        args.progress.finish()
+    output(result, args.json)
+    return code
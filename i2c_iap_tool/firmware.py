@@ -0,0 +1,359 @@
+import os
+import re
+import json
+import hashlib
+from collections import namedtuple
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+FIRMWARE_CACHE_DIR = "~/.cache/fusion_hat_iap"
+FIRMWARE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "firmware")
+
+NUMPY_MIN_LEN = 256 # below this, int folding is faster than numpy call overhead
+
+
+def xor_checksum(data):
+    # XOR of all bytes. numpy reduces it when available, otherwise the bytes
+    # are read as one int and folded in halves down to a single byte.
+    # numpy only reads buffers, lists of ints take the int path
+    if numpy is not None and len(data) >= NUMPY_MIN_LEN and isinstance(data, (bytes, bytearray, memoryview)):
+        return int(numpy.bitwise_xor.reduce(numpy.frombuffer(data, dtype=numpy.uint8)))
+    value = int.from_bytes(data, 'little')
+    num = len(data)
+    while num > 1:
+        half = (num + 1) // 2
+        value = (value >> (half*8)) ^ (value & ((1 << (half*8)) - 1))
+        num = half
+    return value
+
+
+class FirmwareImage:
+    # firmware bytes, padded once with 0xFF to 4 bytes aligned and
+    # sliced through a memoryview, so frame payloads are never copied
+    def __init__(self, data, path=None, checksum=None):
+        self.path = path
+        self.data = bytes(data)
+        self._padded = self.data + b'\xff'*(-len(self.data) % 4)
+        self.view = memoryview(self._padded)
+        self._checksum = checksum
+        self._sha256 = None
+
+    @classmethod
+    def from_file(cls, path, checksum=None):
+        with open(path, 'rb') as f:
+            return cls(f.read(), path, checksum)
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def padding(self):
+        # 0xFF bytes appended to the last frame payload
+        return len(self._padded) - len(self.data)
+
+    @property
+    def checksum(self):
+        # XOR checksum of the image, as sent in the VERIFY command
+        if self._checksum is None:
+            self._checksum = xor_checksum(self.data)
+        return self._checksum
+
+    @property
+    def sha256(self):
+        if self._sha256 is None:
+            self._sha256 = hashlib.sha256(self.data).hexdigest()
+        return self._sha256
+
+    def frames(self, data_len, start=0, end=None):
+        # yield (data_offset, payload) from start to end, payloads are 4 bytes
+        # aligned views, padded with 0xFF past the end of the image
+        if end is None:
+            end = len(self.data)
+        for data_offset in range(start, end, data_len):
+            stop = min(data_offset + data_len, end)
+            stop += -(stop - data_offset) % 4
+            yield data_offset, self.view[data_offset:stop]
+
+
+class FirmwareCache:
+    # copy of the last firmware burned and verified successfully, one per i2c bus
+    # and mux channel
+    def __init__(self, cache_dir=FIRMWARE_CACHE_DIR, bus=1, mux_channel=None):
+        name = f"last_burned_i2c-{bus}"
+        if mux_channel is not None:
+            name += f"-ch{mux_channel}"
+        self.path = os.path.join(os.path.expanduser(cache_dir), name + ".bin")
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def save(self, data):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(bytes(data))
+            os.replace(tmp_path, self.path)
+            return True
+        except OSError:
+            return False
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+CHECKPOINT_INTERVAL = 1024 # flash page size, a resumed burn erases again from a page boundary
+
+class BurnCheckpoint:
+    # how far a burn of an image got: the page aligned offset below which every
+    # frame was acknowledged, so an interrupted burn can resume from there.
+    # One per i2c bus and mux channel
+    def __init__(self, cache_dir=FIRMWARE_CACHE_DIR, bus=1, mux_channel=None, interval=CHECKPOINT_INTERVAL):
+        name = f"burn_checkpoint_i2c-{bus}"
+        if mux_channel is not None:
+            name += f"-ch{mux_channel}"
+        self.path = os.path.join(os.path.expanduser(cache_dir), name + ".json")
+        self.interval = interval
+        self._offset = 0
+
+    def load(self, sha256):
+        # offset to resume the image from, None if there's no checkpoint for it
+        try:
+            with open(self.path, 'r') as f:
+                checkpoint = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if checkpoint.get("sha256") != sha256 or not checkpoint.get("offset"):
+            return None
+        return checkpoint["offset"]
+
+    def save(self, sha256, offset):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump({"sha256": sha256, "offset": offset}, f)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            return False
+        self._offset = offset
+        return True
+
+    def clear(self):
+        self._offset = 0
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def track(self, sha256, on_progress=None):
+        # progress callback (done, total) saving a checkpoint at every interval
+        # boundary `done` crosses, done being the bytes acknowledged from 0
+        def _on_progress(done, total):
+            offset = done - done % self.interval
+            if offset > self._offset:
+                self.save(sha256, offset)
+            if on_progress is not None:
+                on_progress(done, total)
+        return _on_progress
+
+
+class TransitionCache:
+    # mode transition latencies last measured on a board, {mode: seconds}, so
+    # a new session (every CLI run, every board of a fleet) starts with them.
+    # One per i2c bus and mux channel
+    def __init__(self, cache_dir=FIRMWARE_CACHE_DIR, bus=1, mux_channel=None):
+        name = f"transition_i2c-{bus}"
+        if mux_channel is not None:
+            name += f"-ch{mux_channel}"
+        self.path = os.path.join(os.path.expanduser(cache_dir), name + ".json")
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                latencies = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(latencies, dict):
+            return {}
+        return {mode: x for mode, x in latencies.items() if isinstance(x, (int, float)) and x >= 0}
+
+    def save(self, latencies):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(latencies, f)
+            os.replace(tmp_path, self.path)
+            return True
+        except OSError:
+            return False
+
+
+# =============================================================
+# Firmware directory
+
+# e.g. Fusion_Hat_firmmware_g32e230_1.1.4.bin
+FIRMWARE_NAME_PATTERN = re.compile(r"^(?P<board>.+)_(?P<chip>[A-Za-z0-9]+)_(?P<version>\d+(?:\.\d+)*)\.bin$")
+
+# board name prefix of the file name: board id, as in BOARD_ID_REG_ADDR
+BOARD_IDS = {
+    "fusion_hat": 1908,
+}
+
+FirmwareInfo = namedtuple("FirmwareInfo", ["name", "path", "size", "chip", "version"])
+
+def parse_firmware_name(file_name):
+    # return (chip, version tuple), or (None, None) for other names
+    match = FIRMWARE_NAME_PATTERN.match(os.path.basename(file_name))
+    if match is None:
+        return None, None
+    return match.group("chip"), tuple(int(x) for x in match.group("version").split("."))
+
+def parse_board_id(file_name):
+    name = os.path.basename(file_name).lower()
+    for prefix, board_id in BOARD_IDS.items():
+        if name.startswith(prefix):
+            return board_id
+    return None
+
+
+class FirmwareRepository:
+    # .bin files under the firmware directory. Indexed on first access and
+    # again only when the mtime of an indexed directory changed
+    def __init__(self, firmware_dir=FIRMWARE_DIR):
+        self.firmware_dir = firmware_dir
+        self._dir_mtimes = None # {dir: mtime} of the last index
+        self._files = []
+
+    def _is_stale(self):
+        if self._dir_mtimes is None:
+            return True
+        for path, mtime in self._dir_mtimes.items():
+            try:
+                if os.stat(path).st_mtime_ns != mtime:
+                    return True
+            except OSError:
+                return True
+        return False
+
+    def refresh(self):
+        dir_mtimes = {}
+        files = []
+        for root, dirs, names in os.walk(self.firmware_dir):
+            try:
+                dir_mtimes[root] = os.stat(root).st_mtime_ns
+            except OSError:
+                continue
+            for name in names:
+                if not name.endswith(".bin"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    size = os.path.getsize(path)
+                except OSError:
+                    continue
+                chip, version = parse_firmware_name(name)
+                files.append(FirmwareInfo(os.path.relpath(path, self.firmware_dir), path, size, chip, version))
+        if not dir_mtimes:
+            # missing directory, check it again next time
+            dir_mtimes[self.firmware_dir] = None
+        files.sort(key=lambda x: x.name)
+        self._dir_mtimes = dir_mtimes
+        self._files = files
+        return files
+
+    @property
+    def files(self):
+        if self._is_stale():
+            self.refresh()
+        return self._files
+
+    def __len__(self):
+        return len(self.files)
+
+    def __getitem__(self, index):
+        return self.files[index]
+
+
+# =============================================================
+# Firmware manifest, metadata of every firmware file seen, so the
+# files are read and hashed only once. Kept in the cache directory
+# as the firmware directory may be read-only.
+
+FIRMWARE_MANIFEST = "firmware_manifest.json"
+
+FirmwareMeta = namedtuple("FirmwareMeta", ["size", "checksum", "sha256", "board_id", "version"])
+
+class FirmwareManifest:
+    def __init__(self, cache_dir=FIRMWARE_CACHE_DIR):
+        self.path = os.path.join(os.path.expanduser(cache_dir), FIRMWARE_MANIFEST)
+        self._entries = None # {abs path: entry}
+        self._dirty = False
+
+    def _load(self):
+        if self._entries is None:
+            try:
+                with open(self.path, 'r') as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError):
+                self._entries = {}
+        return self._entries
+
+    def get(self, path, data=None):
+        # metadata of the file at `path`, computed from `data` or the file when
+        # it's unknown or the file changed (mtime or size). None if unreadable
+        path = os.path.abspath(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        entries = self._load()
+        entry = entries.get(path)
+        if entry is None or entry["mtime"] != st.st_mtime_ns or entry["size"] != st.st_size:
+            if data is None:
+                try:
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                except OSError:
+                    return None
+            _, version = parse_firmware_name(path)
+            entry = {
+                "mtime": st.st_mtime_ns,
+                "size": len(data),
+                "checksum": xor_checksum(data),
+                "sha256": hashlib.sha256(data).hexdigest(),
+                "board_id": parse_board_id(path),
+                "version": list(version) if version is not None else None,
+            }
+            entries[path] = entry
+            self._dirty = True
+        version = tuple(entry["version"]) if entry["version"] is not None else None
+        return FirmwareMeta(entry["size"], entry["checksum"], entry["sha256"], entry["board_id"], version)
+
+    def save(self):
+        # write the manifest if anything changed, drop entries of removed files
+        if not self._dirty:
+            return True
+        entries = {path: entry for path, entry in self._load().items() if os.path.exists(path)}
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(entries, f, indent=2)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            return False
+        self._entries = entries
+        self._dirty = False
+        return True
@@ -0,0 +1,181 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .i2c import I2C, scan_buses, MUX_CHANNELS
+from .iap import Iap, IAP_OK, IAP_NACK_ERR, firmware_is_current
+from .session import flash_image, failed, ensure_boot_mode, ERROR_NO_DEVICE
+from .firmware import FirmwareCache, FirmwareImage, FIRMWARE_CACHE_DIR
+
+# =============================================================
+# Flash several boards at once, one independent Iap session per
+# i2c bus (/dev/i2c-N), run in a thread pool, or several boards
+# behind an i2c mux on one bus, with burn frames interleaved.
+
+MAX_BUS_NUM = 32
+
+
+def discover_buses(globals, buses=None):
+    # i2c buses with a device answering at the app or boot address
+    if buses is None:
+        buses = [bus for bus in range(MAX_BUS_NUM) if I2C.enabled(bus)]
+    devices = scan_buses(buses, [globals["APP_I2C_ADDR"], globals["BOOT_I2C_ADDR"]])
+    return [bus for bus in buses if devices[bus]]
+
+
+class FleetProgress:
+    # aggregated progress of all sessions, reported as (done, total) bytes
+    def __init__(self, buses, on_progress=None):
+        self.on_progress = on_progress
+        self._lock = threading.Lock()
+        self._progress = {bus: (0, 0) for bus in buses}
+
+    def update(self, bus, done, total):
+        with self._lock:
+            self._progress[bus] = (done, total)
+            done = sum(x[0] for x in self._progress.values())
+            total = sum(x[1] for x in self._progress.values())
+        if self.on_progress is not None:
+            self.on_progress(done, total)
+
+    def bus_callback(self, bus):
+        return lambda done, total: self.update(bus, done, total)
+
+
+def flash_bus(globals, bus, data, full=False, reset=True, on_progress=None, version=None, force=False,
+              incremental=None):
+    result = {"bus": bus, "ok": False}
+    try:
+        with Iap(globals, bus=bus) as iap:
+            result = flash_image(iap, data, result, full=full, reset=reset, on_progress=on_progress,
+                                    version=version, force=force, incremental=incremental)
+    except OSError as e:
+        failed(result, f"i2c error: {e}")
+    return result
+
+
+def flash_buses(globals, buses, data, workers=None, full=False, reset=True, on_progress=None,
+                version=None, force=False, incremental=None):
+    # flash every bus in parallel, return {bus: result}
+    progress = FleetProgress(buses, on_progress)
+    if workers is None:
+        workers = len(buses)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {
+            bus: executor.submit(flash_bus, globals, bus, data, full, reset, progress.bus_callback(bus),
+                                 version, force, incremental)
+            for bus in buses
+        }
+        return {bus: future.result() for bus, future in futures.items()}
+
+
+# =============================================================
+# Boards behind a mux share one bus, so they are driven from one
+# thread. Channel selection is cached by I2C.
+
+def discover_mux_channels(globals, bus, mux_addr, channels=None):
+    if channels is None:
+        channels = range(MUX_CHANNELS)
+    found = []
+    for channel in channels:
+        try:
+            with Iap(globals, bus=bus, mux_addr=mux_addr, mux_channel=channel) as iap:
+                if iap.get_mode() is not None:
+                    found.append(channel)
+        except OSError:
+            pass
+    return found
+
+
+def interleave_burn(sessions, data, on_progress=None):
+    # sessions: {key: Iap} already in boot mode and erased. every round writes
+    # the next frame to each board, then collects the statuses, so a bootloader
+    # programs its frame while the other boards are addressed.
+    # return {key: status of the last frame}
+    image = data if isinstance(data, FirmwareImage) else FirmwareImage(data)
+    data_len = len(image)
+    frames = {key: iter(iap.encode(image).frames) for key, iap in sessions.items()}
+    current = {}
+    statuses = {key: IAP_OK for key in sessions}
+    active = list(sessions)
+    while active:
+        sent = {}
+        for key in list(active):
+            iap = sessions[key]
+            current[key] = next(frames[key], None)
+            if current[key] is None:
+                active.remove(key)
+                continue
+            data_offset, frame = current[key]
+            sent[key] = iap._write_frame(frame)
+        for key in list(active):
+            iap = sessions[key]
+            data_offset, frame = current[key]
+            status = iap._read_status(iap._timeout("WRITE")) if sent[key] else IAP_NACK_ERR
+            if status != IAP_OK:
+                # resend this frame alone
+                status = iap.retry.run(lambda: iap.burn_frame(frame), iap.stats, status)
+                if status != IAP_OK:
+                    statuses[key] = status
+                    active.remove(key)
+                    continue
+            if on_progress is not None:
+                on_progress(key, min(data_offset + iap.data_len, data_len), data_len)
+    return statuses
+
+
+def flash_mux_channels(globals, bus, mux_addr, channels, data, reset=True, on_progress=None,
+                       version=None, force=False):
+    # full erase and burn of every board behind a mux, return {channel: result}.
+    # boards already running `version` are skipped, unless force
+    progress = FleetProgress(channels, on_progress)
+    image = FirmwareImage(data)
+    results = {}
+    sessions = {}
+    opened = []
+    try:
+        for channel in channels:
+            result = {"bus": bus, "channel": channel, "ok": False}
+            results[channel] = result
+            try:
+                iap = Iap(globals, bus=bus, mux_addr=mux_addr, mux_channel=channel)
+                opened.append(iap)
+                if iap.get_mode() is None:
+                    failed(result, ERROR_NO_DEVICE)
+                    continue
+                cache = FirmwareCache(globals.get("FIRMWARE_CACHE_DIR", FIRMWARE_CACHE_DIR), bus, channel)
+                if not force and firmware_is_current(iap.read_device_info(), version, image.checksum, cache.load()):
+                    result["skipped"] = True
+                    result["ok"] = True
+                    continue
+                if not ensure_boot_mode(iap):
+                    failed(result, "entering bootloader failed")
+                    continue
+                iap.negotiate_data_len()
+                cache.clear()
+                if not iap.earse_flash(len(data)):
+                    failed(result, "erase flash failed")
+                    continue
+                sessions[channel] = iap
+            except OSError as e:
+                failed(result, f"i2c error: {e}")
+
+        statuses = interleave_burn(sessions, image, on_progress=progress.update)
+
+        for channel, iap in sessions.items():
+            result = results[channel]
+            try:
+                if statuses[channel] != IAP_OK:
+                    failed(result, f"burn failed 0x{statuses[channel]:02x}")
+                elif not iap.verify_data(image):
+                    failed(result, "verify failed")
+                else:
+                    FirmwareCache(globals.get("FIRMWARE_CACHE_DIR", FIRMWARE_CACHE_DIR), bus, channel).save(data)
+                    if reset:
+                        result["reset"] = iap.reset_device()
+                    result["ok"] = True
+            except OSError as e:
+                failed(result, f"i2c error: {e}")
+    finally:
+        for iap in opened:
+            iap.close()
+    return results
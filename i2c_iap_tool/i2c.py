@@ -1,47 +1,128 @@
-from smbus2 import SMBus
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from smbus2 import SMBus, i2c_msg
+
+SCAN_ADDRESSES = range(0x03, 0x77 + 1)
+MUX_CHANNELS = 8 # TCA9548A
+
+
+class SMBusPool:
+    # one open SMBus per bus number, shared by every I2C on that bus and
+    # closed when the last user releases it. A shared handle must not be
+    # used from several threads at once, transactions on a bus are serial anyway
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._handles = {} # bus: [SMBus, refs]
+
+    def acquire(self, bus):
+        with self._lock:
+            if bus not in self._handles:
+                self._handles[bus] = [SMBus(bus), 0]
+            self._handles[bus][1] += 1
+            return self._handles[bus][0]
+
+    def release(self, bus):
+        with self._lock:
+            if bus not in self._handles:
+                return
+            self._handles[bus][1] -= 1
+            if self._handles[bus][1] <= 0:
+                self._handles.pop(bus)[0].close()
+
+    def close(self):
+        # close every handle, e.g. on exit
+        with self._lock:
+            for handle, _ in self._handles.values():
+                handle.close()
+            self._handles.clear()
+
+smbus_pool = SMBusPool()
+
 
 class I2C():
     MASTER = 0
     SLAVE  = 1
     RETRY = 5
+    BLOCK_MAX = 32 # SMBus block transfer limit
 
-    def __init__(self, addr, bus=1):     
+    # channel last selected on every (bus, mux_addr), shared by all instances
+    _mux_channels = {}
+
+    def __init__(self, addr, bus=1, mux_addr=None, mux_channel=None):
         self._bus = bus
         self._addr = addr
-        self._smbus = SMBus(self._bus)
+        self._mux_addr = mux_addr
+        self._mux_channel = mux_channel
+        self._smbus = smbus_pool.acquire(self._bus)
+
+    def close(self):
+        # release the shared handle, the instance can't be used afterwards
+        if self._smbus is not None:
+            self._smbus = None
+            smbus_pool.release(self._bus)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _select(self):
+        # select our channel on a TCA9548A style mux, skipped if already selected
+        if self._mux_addr is None:
+            return
+        key = (self._bus, self._mux_addr)
+        if I2C._mux_channels.get(key) == self._mux_channel:
+            return
+        try:
+            self._smbus.write_byte(self._mux_addr, 1 << self._mux_channel)
+        except OSError:
+            I2C._mux_channels.pop(key, None)
+            raise
+        I2C._mux_channels[key] = self._mux_channel
 
     def _write_byte(self, data):                      # i2C write function
+        self._select()
         return self._smbus.write_byte(self._addr, data)
 
     def _write_byte_data(self, reg, data):
+        self._select()
         return self._smbus.write_byte_data(self._addr, reg, data)
 
     def _write_word_data(self, reg, data):
+        self._select()
         return self._smbus.write_word_data(self._addr, reg, data)
 
     def _write_block_data(self, reg, data):
+        self._select()
         return self._smbus.write_i2c_block_data(self._addr, reg, data)
 
     def _read_byte(self):                             # i2C read functions
+        self._select()
         return self._smbus.read_byte(self._addr)
 
     def _read_byte_data(self, reg):
+        self._select()
         result = self._smbus.read_byte_data(self._addr, reg)
         return result
 
     def _read_word_data(self, reg):
+        self._select()
         result = self._smbus.read_word_data(self._addr, reg)
         result_list = [result & 0xFF, (result >> 8) & 0xFF]
         return result_list
     
     def _read_block_data(self, reg, num):
+        self._select()
         return self._smbus.read_i2c_block_data(self._addr, reg, num)
 
     def is_ready(self):
-        addresses = I2C.scan(self._bus)
-        if self._addr in addresses:
+        # probe only our own address, one transaction on the open handle
+        try:
+            self._select()
+            self._smbus.read_byte(self._addr)
             return True
-        else:
+        except OSError:
             return False
 
     @staticmethod
@@ -50,22 +131,8 @@ class I2C():
         return os.path.exists("/dev/i2c-{}".format(bus))
 
     @staticmethod
-    def scan(busnum=1, force=False):
-        devices = []
-        for addr in range(0x03, 0x77 + 1):
-            read = SMBus.read_byte, (addr,), {'force':force}
-            write = SMBus.write_byte, (addr, 0), {'force':force}
-            for func, args, kwargs in (read, write):
-                try:
-                    with SMBus(busnum) as bus:
-                        data = func(bus, *args, **kwargs)
-                        devices.append(addr)
-                        break
-                except OSError as expt:
-                    if expt.errno == 16:
-                        # just busy, maybe permanent by a kernel driver or just temporary by some user code
-                        pass
-        return devices
+    def scan(busnum=1, force=False, addrs=None):
+        return scan_bus(busnum, addrs, force)
 
     def send(self, send, timeout=0):                      # sending data. `send`: data to be sent, `addr`: receiver's address 
         if isinstance(send, bytearray):
@@ -142,3 +209,66 @@ class I2C():
 
     def writeto_mem(self, memaddr, data):
         self.mem_write(data, memaddr)
+
+
+class I2CRdwr(I2C):
+    # raw i2c transfers through SMBus.i2c_rdwr, not limited to 32 bytes blocks
+    # WRITE payloads stay capped at 252 bytes by the frame len field (see
+    # Iap.max_data_len), the larger limit only lifts block reads off 32 bytes
+    BLOCK_MAX = 1024 + 8
+
+    def _write_block_data(self, reg, data):
+        self._select()
+        msg = i2c_msg.write(self._addr, bytes([reg]) + bytes(data))
+        self._smbus.i2c_rdwr(msg)
+
+    def _read_block_data(self, reg, num):
+        self._select()
+        write = i2c_msg.write(self._addr, [reg])
+        read = i2c_msg.read(self._addr, num)
+        self._smbus.i2c_rdwr(write, read)
+        return list(read)
+
+
+def scan_bus(busnum=1, addrs=None, force=False):
+    # addresses in `addrs` (default: all) answering on one bus, probed
+    # with a read then a write. The scan opens its own handle: the pooled one
+    # belongs to the sessions on this bus, and SMBus keeps the slave address
+    # on the handle, so probing through it from a scan thread could send a
+    # session's next transfer to a probed address
+    if addrs is None:
+        addrs = SCAN_ADDRESSES
+    devices = []
+    try:
+        bus = SMBus(busnum)
+    except OSError:
+        return devices
+    try:
+        for addr in addrs:
+            for func, args in ((bus.read_byte, (addr,)), (bus.write_byte, (addr, 0))):
+                try:
+                    func(*args, force=force)
+                    devices.append(addr)
+                    break
+                except OSError as expt:
+                    if expt.errno == 16:
+                        # just busy, maybe permanent by a kernel driver or just temporary by some user code
+                        pass
+    finally:
+        bus.close()
+    return devices
+
+def scan_buses(buses, addrs=None, force=False, workers=None):
+    # scan several buses at once, one thread per bus, return {bus: [addrs]}
+    buses = list(buses)
+    if not buses:
+        return {}
+    with ThreadPoolExecutor(max_workers=workers or len(buses)) as executor:
+        futures = {bus: executor.submit(scan_bus, bus, addrs, force) for bus in buses}
+        return {bus: future.result() for bus, future in futures.items()}
+
+
+I2C_TRANSPORTS = {
+    "smbus": I2C,
+    "rdwr": I2CRdwr,
+}
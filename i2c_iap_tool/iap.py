@@ -1,5 +1,10 @@
 import time
-from .i2c import I2C
+import logging
+from collections import namedtuple, OrderedDict
+from .i2c import I2C, I2C_TRANSPORTS
+from .firmware import FirmwareImage, TransitionCache, xor_checksum, FIRMWARE_CACHE_DIR
+
+logger = logging.getLogger(__name__)
 
 # =============================================================
 # Enter boot mode
@@ -42,9 +47,12 @@ ADV_CMD_ENTER_BOOT = 0x04
 
 
 PAGE_SIZE = 1024 # 1K
-IAP_DATA_LEN = 24 # 4bytes aligned
+IAP_DATA_LEN = 24 # 4bytes aligned, default when not set in globals
 IAP_RETRY_TIMES= 5
 
+IAP_FRAME_OVERHEAD = 6 # cmd, checksum, len, data_offset(2), end. start is sent as the register
+IAP_LEN_FIELD_MAX = 0xFF # len is u8, data_offset + data
+
 IAP_CMD_START = 0xD0
 IAP_CMD_END = 0xED
 
@@ -65,13 +73,394 @@ IAP_DATA_ERR = 0xE5
 
 IAP_NACK_ERR = 0xFF
 
+# =============================================================
+# Frame encoding
+
+EncodedImage = namedtuple("EncodedImage", ["frames", "checksum"]) # frames: [(data_offset, frame)]
+
+ENCODED_CACHE_SIZE = 4
+
+def encode_write_frames(image, data_len):
+    # build every WRITE frame of the image and the whole image checksum in one pass
+    frames = []
+    image_check_sum = 0
+    for data_offset, payload in image.frames(data_len):
+        payload_check_sum = xor_checksum(payload)
+        image_check_sum ^= payload_check_sum
+        offset_h = (data_offset >> 8) & 0xFF
+        offset_l = data_offset & 0xFF
+        check_sum = payload_check_sum ^ offset_h ^ offset_l
+        frame = bytes([IAP_CMD_START, IAP_CMD_WRITE, check_sum, len(payload) + 2, offset_h, offset_l]) \
+            + payload + bytes([IAP_CMD_END])
+        frames.append((data_offset, frame))
+    # the last payload is padded with 0xFF, which the image checksum must not include
+    if image.padding % 2 == 1:
+        image_check_sum ^= 0xFF
+    return EncodedImage(frames, image_check_sum)
+
+class FrameCache:
+    # encoded frames of the last few images, so retries and re-flashes of
+    # the same file skip the encoding
+    def __init__(self, size=ENCODED_CACHE_SIZE):
+        self.size = size
+        self._cache = OrderedDict()
+
+    def get(self, image, data_len):
+        key = (image.data, data_len)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        encoded = encode_write_frames(image, data_len)
+        self._cache[key] = encoded
+        while len(self._cache) > self.size:
+            self._cache.popitem(last=False)
+        return encoded
+
+frame_cache = FrameCache()
+
+# =============================================================
+# Statistics
+
+class IapStats:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.frames = 0
+        self.retries = 0
+        self.retry_statuses = {} # status that caused a resend: count
+        self.ack_latencies = [] # seconds, frame written to status read
+
+    def add_ack(self, latency):
+        self.frames += 1
+        self.ack_latencies.append(latency)
+
+    def add_retry(self, status):
+        self.retries += 1
+        self.retry_statuses[status] = self.retry_statuses.get(status, 0) + 1
+
+# =============================================================
+# Backoff schedule. The policies below only decide and schedule, the
+# loops that sleep are Iap's (time.sleep) and AsyncIap's (asyncio.sleep),
+# so both follow the same policy.
+
+class Backoff:
+    def __init__(self, floor, ceiling, factor=2):
+        self.floor = floor
+        self.ceiling = ceiling
+        self.factor = factor
+
+    def delays(self):
+        # floor, then multiplied by factor up to ceiling
+        delay = self.floor
+        while True:
+            yield delay
+            delay = min(delay * self.factor, self.ceiling)
+
+# =============================================================
+# Retry policy. A frame is resent alone, with backoff, only for statuses
+# a resend can fix: corrupted on the bus or not answered. Flash, size
+# and alignment errors are fatal.
+
+IAP_RETRYABLE_STATUSES = (IAP_CHECKSUM_ERR, IAP_DATA_ERR, IAP_NACK_ERR)
+RETRY_FLOOR = 0.002
+RETRY_CEILING = 0.05
+
+class RetryPolicy(Backoff):
+    def __init__(self, times=IAP_RETRY_TIMES, retryable=IAP_RETRYABLE_STATUSES,
+                 floor=RETRY_FLOOR, ceiling=RETRY_CEILING, factor=2):
+        super().__init__(floor, ceiling, factor)
+        self.times = times # attempts in all, the first one included
+        self.retryable = retryable
+
+    def is_retryable(self, status):
+        return status in self.retryable
+
+    def should_retry(self, status, attempts):
+        # None: nothing sent yet, one attempt is always made
+        if status is None:
+            return True
+        return status != IAP_OK and self.is_retryable(status) and attempts < self.times
+
+    def run(self, send, stats=None, status=None):
+        # call send() until IAP_OK, a fatal status or `times` attempts, return
+        # the last status. `status` is the result of an attempt already made.
+        # OSError counts as IAP_NACK_ERR
+        attempts = 0 if status is None else 1
+        delays = self.delays()
+        while self.should_retry(status, attempts):
+            if status is not None:
+                if stats is not None:
+                    stats.add_retry(status)
+                time.sleep(next(delays))
+            try:
+                status = send()
+            except OSError:
+                status = IAP_NACK_ERR
+            attempts += 1
+        return status
+
+# =============================================================
+# Device mode
+
+APP_MODE = "app"
+BOOT_MODE = "boot"
+
+MODE_CACHE_TTL = 0.5 # seconds
+
+class ModeState:
+    def __init__(self, app_i2c, boot_i2c, ttl=MODE_CACHE_TTL):
+        self.app_i2c = app_i2c
+        self.boot_i2c = boot_i2c
+        self.ttl = ttl
+        self._mode = None
+        self._timestamp = None
+
+    def detect(self):
+        if self.app_i2c.is_ready():
+            mode = APP_MODE
+        elif self.boot_i2c.is_ready():
+            mode = BOOT_MODE
+        else:
+            mode = None
+        self._mode = mode
+        self._timestamp = time.time()
+        return mode
+
+    def get(self):
+        if self._timestamp is None or time.time() - self._timestamp > self.ttl:
+            return self.detect()
+        return self._mode
+
+    def invalidate(self):
+        self._mode = None
+        self._timestamp = None
+
+# =============================================================
+# Status polling
+
+IAP_POLL_FLOOR = 0.0005 # seconds
+IAP_POLL_CEILING = 0.02 # seconds
+IAP_TIMEOUT = 5 # seconds, default per command timeout
+
+class BackoffWait(Backoff):
+    def __init__(self, floor=IAP_POLL_FLOOR, ceiling=IAP_POLL_CEILING, factor=2):
+        super().__init__(floor, ceiling, factor)
+
+    def wait(self, read, timeout):
+        # read at once, then back off exponentially from floor to ceiling.
+        # return None on timeout
+        _st = time.time()
+        for delay in self.delays():
+            try:
+                return read()
+            except OSError:
+                pass
+            if time.time() - _st >= timeout:
+                return None
+            time.sleep(delay)
+
+# =============================================================
+# Device info
+
+DeviceInfo = namedtuple("DeviceInfo", ["mode", "boot_version", "app_version", "factory_version", "main_entry"])
+
+# name, app mode register, boot mode register, length
+DEVICE_INFO_REGS = [
+    ("boot_version", "BOOT_VERSION_REG_ADDR", "BOOT_VERSION_REG_ADDR_BOOT", 3),
+    ("app_version", "APP_VERSION_REG_ADDR", "APP_VERSION_REG_ADDR_BOOT", 3),
+    ("factory_version", "FACTORY_VERSION_REG_ADDR", "FACTORY_VERSION_REG_ADDR_BOOT", 3),
+    ("main_entry", "MIAN_ENTRY_REG_ADDR", "MIAN_ENTRY_REG_ADDR_BOOT", 4),
+]
+
+def block_windows(spans, max_len):
+    # merge (reg, len) spans into as few block reads of at most max_len bytes as possible
+    windows = []
+    for reg, num in sorted(spans):
+        if windows and reg + num - windows[-1][0] <= max_len:
+            start, length = windows[-1]
+            windows[-1] = (start, max(length, reg + num - start))
+        else:
+            windows.append((reg, num))
+    return windows
+
+# Mode transition. After ENTER_BOOT the device re-enumerates at the boot
+# address; only that address is probed, backing off, and the time it took
+# is remembered, the next wait sleeps most of it before probing. With a
+# TransitionCache it is remembered across sessions.
+
+TRANSITION_TIMEOUT = 5
+TRANSITION_POLL_FLOOR = 0.005
+TRANSITION_POLL_CEILING = 0.05
+TRANSITION_HEADSTART = 0.8 # part of the last measured latency slept before probing
+
+class TransitionWaiter(Backoff):
+    def __init__(self, floor=TRANSITION_POLL_FLOOR, ceiling=TRANSITION_POLL_CEILING, factor=2, cache=None):
+        super().__init__(floor, ceiling, factor)
+        self.cache = cache
+        self.latencies = cache.load() if cache is not None else {} # mode: seconds, last measured
+
+    def headstart(self, mode):
+        return self.latencies.get(mode, 0) * TRANSITION_HEADSTART
+
+    def record(self, mode, latency):
+        self.latencies[mode] = latency
+        if self.cache is not None:
+            self.cache.save(self.latencies)
+        return latency
+
+    def wait(self, mode, probe, timeout=TRANSITION_TIMEOUT):
+        # return the seconds until probe() was True, None on timeout
+        _st = time.time()
+        time.sleep(self.headstart(mode))
+        for delay in self.delays():
+            try:
+                if probe():
+                    return self.record(mode, time.time() - _st)
+            except OSError:
+                pass
+            if time.time() - _st >= timeout:
+                return None
+            time.sleep(delay)
+
+# =============================================================
+# Flash pages
+
+def changed_pages(old, new, page_size=PAGE_SIZE):
+    # index of every page of `new` that differs from `old`
+    old = bytes(old)
+    new = bytes(new)
+    pages = []
+    for i in range(0, len(new), page_size):
+        if old[i:i+page_size] != new[i:i+page_size]:
+            pages.append(i // page_size)
+    return pages
+
+def page_runs(pages):
+    # merge page indexes into (start_page, page_num) runs
+    runs = []
+    for page in sorted(pages):
+        if runs and runs[-1][0] + runs[-1][1] == page:
+            runs[-1] = (runs[-1][0], runs[-1][1] + 1)
+        else:
+            runs.append((page, 1))
+    return runs
+
+# =============================================================
+
+def format_version(result):
+    return f"{result[0]}.{result[1]}.{result[2]}"
+
+def format_main_entry(result):
+    result = result[0] << 24 | result[1] << 16 | result[2] << 8 | result[3]
+    return f'0x{result:08X}'
+
+def firmware_is_current(info, version, checksum=None, cached=None):
+    # True if the device already runs the firmware: it's in app mode with the
+    # same app version and, when a copy of the last burned image is cached,
+    # that copy has the same checksum. version is a tuple, e.g. (1, 1, 4)
+    if info.mode != APP_MODE or version is None or info.app_version is None:
+        return False
+    if info.app_version != format_version(version):
+        return False
+    if checksum is not None and cached is not None and xor_checksum(cached) != checksum:
+        return False
+    return True
+
 # =============================================================
 
 class Iap:
-    def __init__(self, globals):
+    def __init__(self, globals, waiter=None, app_i2c=None, boot_i2c=None, bus=1, mux_addr=None, mux_channel=None,
+                 transition=None):
         self.globals = globals
-        self.app_i2c = I2C(addr=self.globals["APP_I2C_ADDR"], bus=1)
-        self.boot_i2c = I2C(addr=self.globals["BOOT_I2C_ADDR"], bus=1)
+        self.bus = bus
+        self.mux_addr = mux_addr
+        self.mux_channel = mux_channel
+        # app_i2c / boot_i2c can be any object with the I2C interface, e.g. a simulator
+        transport = I2C_TRANSPORTS[self.globals.get("I2C_TRANSPORT", "smbus")]
+        self._own_i2c = [] # created here, closed by close()
+        if app_i2c is None:
+            app_i2c = transport(addr=self.globals["APP_I2C_ADDR"], bus=self.bus,
+                                mux_addr=mux_addr, mux_channel=mux_channel)
+            self._own_i2c.append(app_i2c)
+        if boot_i2c is None:
+            boot_i2c = transport(addr=self.globals["BOOT_I2C_ADDR"], bus=self.bus,
+                                 mux_addr=mux_addr, mux_channel=mux_channel)
+            self._own_i2c.append(boot_i2c)
+        self.app_i2c = app_i2c
+        self.boot_i2c = boot_i2c
+        self.mode = ModeState(self.app_i2c, self.boot_i2c,
+                              ttl=self.globals.get("MODE_CACHE_TTL", MODE_CACHE_TTL))
+        if transition is None:
+            cache_dir = self.globals.get("FIRMWARE_CACHE_DIR", FIRMWARE_CACHE_DIR)
+            transition = TransitionWaiter(cache=TransitionCache(cache_dir, bus=bus, mux_channel=mux_channel))
+        self.transition = transition
+        self.retry = RetryPolicy(times=self.globals.get("IAP_RETRY_TIMES", IAP_RETRY_TIMES))
+        self.data_len = self.align_data_len(self.globals.get("IAP_DATA_LEN", IAP_DATA_LEN))
+        if waiter is None:
+            waiter = BackoffWait(floor=self.globals.get("IAP_POLL_FLOOR", IAP_POLL_FLOOR),
+                                 ceiling=self.globals.get("IAP_POLL_CEILING", IAP_POLL_CEILING))
+        self.waiter = waiter
+        # debug events, frame dumps are only produced in verbose mode
+        self.verbose = self.globals.get("IAP_VERBOSE", False)
+        self.on_debug = None
+        self.stats = IapStats()
+        # reusable write frame buffer, largest frame the len field allows
+        self._frame = bytearray(IAP_FRAME_OVERHEAD + 1 + IAP_LEN_FIELD_MAX)
+        self._frame_view = memoryview(self._frame)
+
+    def close(self):
+        # release the bus handles, injected app_i2c / boot_i2c are left open
+        for i2c in self._own_i2c:
+            i2c.close()
+        self._own_i2c = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _debug(self, msg):
+        logger.debug(msg)
+        if self.on_debug is not None:
+            self.on_debug(msg)
+
+    def max_data_len(self):
+        # largest payload the transport and the frame len field can carry
+        _max = min(self.boot_i2c.BLOCK_MAX - IAP_FRAME_OVERHEAD, IAP_LEN_FIELD_MAX - 2)
+        return _max - _max % 4
+
+    def align_data_len(self, data_len):
+        data_len = min(data_len, self.max_data_len())
+        return data_len - data_len % 4
+
+    def negotiate_data_len(self):
+        # ask the bootloader for its max accepted payload, if it reports one
+        data_len = self.globals.get("IAP_DATA_LEN", IAP_DATA_LEN)
+        reg = self.globals.get("IAP_MAX_DATA_LEN_REG_ADDR_BOOT")
+        if reg is not None and self.mode.get() == BOOT_MODE:
+            try:
+                result = self.boot_i2c._read_block_data(reg, 2)
+                device_max = result[0] << 8 | result[1]
+                if device_max > 0:
+                    data_len = min(data_len, device_max)
+            except OSError:
+                pass
+        self.data_len = self.align_data_len(data_len)
+        return self.data_len
+
+    def get_mode(self):
+        return self.mode.get()
+
+    def _read_info_reg(self, app_reg, boot_reg, num):
+        mode = self.mode.get()
+        if mode == APP_MODE:
+            return self.app_i2c._read_block_data(self.globals[app_reg], num)
+        elif mode == BOOT_MODE:
+            return self.boot_i2c._read_block_data(self.globals[boot_reg], num)
+        else:
+            return None
 
     def check_boot_mode(self):
         if self.boot_i2c.is_ready():
@@ -89,79 +478,77 @@ class Iap:
             return False
 
     def get_boot_verion(self):
-        if self.app_i2c.is_ready():
-            result = self.app_i2c._read_block_data(self.globals["BOOT_VERSION_REG_ADDR"], 3)
-        elif self.boot_i2c.is_ready():
-            result = self.boot_i2c._read_block_data(self.globals["BOOT_VERSION_REG_ADDR_BOOT"], 3)
-        else:
+        result = self._read_info_reg("BOOT_VERSION_REG_ADDR", "BOOT_VERSION_REG_ADDR_BOOT", 3)
+        if result is None:
             return None
-
-        major = result[0]
-        minor = result[1]
-        patch = result[2]
-
-        return f"{major}.{minor}.{patch}"
+        return format_version(result)
 
     def get_app_verion(self):
-        if self.app_i2c.is_ready():
-            result = self.app_i2c._read_block_data(self.globals["APP_VERSION_REG_ADDR"], 3)
-        elif self.boot_i2c.is_ready():
-            result = self.boot_i2c._read_block_data(self.globals["APP_VERSION_REG_ADDR_BOOT"], 3)
-        else:
+        result = self._read_info_reg("APP_VERSION_REG_ADDR", "APP_VERSION_REG_ADDR_BOOT", 3)
+        if result is None:
             return None
-
-        major = result[0]
-        minor = result[1]
-        patch = result[2]
-        return f"{major}.{minor}.{patch}"
+        return format_version(result)
 
     def get_factory_verion(self):
-        if self.app_i2c.is_ready():
-            result = self.app_i2c._read_block_data(self.globals["FACTORY_VERSION_REG_ADDR"], 3)
-        elif self.boot_i2c.is_ready():
-            result = self.boot_i2c._read_block_data(self.globals["FACTORY_VERSION_REG_ADDR_BOOT"], 3)
-        else:
+        result = self._read_info_reg("FACTORY_VERSION_REG_ADDR", "FACTORY_VERSION_REG_ADDR_BOOT", 3)
+        if result is None:
             return None
-
-        major = result[0]
-        minor = result[1]
-        patch = result[2]
-        return f"{major}.{minor}.{patch}"
+        return format_version(result)
 
     def get_main_entry(self):
-        if self.app_i2c.is_ready():
-            result =  self.app_i2c._read_block_data(self.globals["MIAN_ENTRY_REG_ADDR"], 4)
-        elif self.boot_i2c.is_ready():
-            result =  self.boot_i2c._read_block_data(self.globals["MIAN_ENTRY_REG_ADDR_BOOT"], 4)
-        else:
+        # main entry is stored big endian
+        result = self._read_info_reg("MIAN_ENTRY_REG_ADDR", "MIAN_ENTRY_REG_ADDR_BOOT", 4)
+        if result is None:
             return None
-        
-        _is_big = True
-        if _is_big:
-            result = result[0] << 24 | result[1] << 16 | result[2] << 8 | result[3]
+        return format_main_entry(result)
+
+    def read_device_info(self):
+        mode = self.mode.get()
+        if mode == APP_MODE:
+            i2c = self.app_i2c
+            regs = [(name, self.globals[app_reg], num) for name, app_reg, _, num in DEVICE_INFO_REGS]
+        elif mode == BOOT_MODE:
+            i2c = self.boot_i2c
+            regs = [(name, self.globals[boot_reg], num) for name, _, boot_reg, num in DEVICE_INFO_REGS]
         else:
-            result = result[3] << 24 | result[2] << 16 | result[1] << 8 | result[0]
-        return f'0x{result:08X}'
+            return DeviceInfo(None, None, None, None, None)
+
+        buffer = {}
+        for start, num in block_windows([(reg, num) for _, reg, num in regs], i2c.BLOCK_MAX):
+            result = i2c._read_block_data(start, num)
+            for i, x in enumerate(result):
+                buffer[start+i] = x
+
+        fields = {}
+        for name, reg, num in regs:
+            fields[name] = [buffer[reg+i] for i in range(num)]
+
+        return DeviceInfo(
+            mode=mode,
+            boot_version=format_version(fields["boot_version"]),
+            app_version=format_version(fields["app_version"]),
+            factory_version=format_version(fields["factory_version"]),
+            main_entry=format_main_entry(fields["main_entry"]),
+        )
 
     def enter_boot_mode(self):
+        self.mode.invalidate()
         self.app_i2c._write_block_data(ADV_CMD_START, [ADV_CMD_ENTER_BOOT, 1, ADV_CMD_END])
         time.sleep(0.1)
         status = self.app_i2c._read_byte()
         if status != IAP_OK:
             return False
         # wait for device to enter iap mode, i2c change to 0x5d
-        time.sleep(1)
-        st = time.time()
-        while time.time() - st < 5:
-            if self.boot_i2c.is_ready():
-                # send ack
-                self.boot_i2c._write_block_data(IAP_CMD_START, [IAP_CMD_ACK, 1, IAP_CMD_END])
-                status = self.boot_i2c._read_byte()
-                if status == IAP_OK:
-                    return True
-                time.sleep(0.01)
-        else:
+        timeout = self.globals.get("IAP_TRANSITION_TIMEOUT", TRANSITION_TIMEOUT)
+        return self.transition.wait(BOOT_MODE, self._boot_ack, timeout) is not None
+
+    def _boot_ack(self):
+        # cheap probe of the boot address, then ACK once it answers. Not a
+        # frame of the update, kept out of stats
+        if not self.boot_i2c.is_ready():
             return False
+        self.boot_i2c._write_block_data(IAP_CMD_START, [IAP_CMD_ACK, 1, IAP_CMD_END])
+        return self.waiter.wait(self.boot_i2c._read_byte, self.transition.ceiling) == IAP_OK
 
     def app_reset_device(self):
         for _ in range(IAP_RETRY_TIMES):
@@ -183,15 +570,35 @@ class Iap:
 
 
     def reset_device(self):
-        if self.app_i2c.is_ready():
+        mode = self.mode.detect()
+        self.mode.invalidate()
+        if mode == APP_MODE:
             return self.app_reset_device()
-        elif self.boot_i2c.is_ready():
+        elif mode == BOOT_MODE:
             return self.boot_reset_device()
         else:
             return False
-        
 
-    def earse_flash(self, file_size):
+    def _timeout(self, name):
+        return self.globals.get(f"IAP_{name}_TIMEOUT", IAP_TIMEOUT)
+
+    def _send_frame(self, frame, timeout=IAP_TIMEOUT):
+        # write a frame, then poll its status while the device is busy. The write
+        # and the read are separate transfers: a failed combined transfer can't tell
+        # a frame that never arrived from a busy device, and the status register
+        # still holds the previous frame's status until the new one is processed
+        _st = time.time()
+        try:
+            self.boot_i2c._write_block_data(frame[0], frame[1:])
+        except OSError:
+            return IAP_NACK_ERR
+        status = self.waiter.wait(self.boot_i2c._read_byte, timeout)
+        self.stats.add_ack(time.time() - _st)
+        if status is None:
+            return IAP_NACK_ERR
+        return status
+
+    def build_erase_frame(self, file_size, start_page=0):
         # | start | cmd | checksum | len | addr             | page_num     | end |
         # | ----- | --- | -------- | --- | ---------------- | ------------- | --- |
         # | 0     | 1   | 2        | 3   | 4~7 （u32, Big） | 8~9(u16, Big) | 10  |
@@ -205,7 +612,7 @@ class Iap:
         page_num = page_num.to_bytes(2, 'big')
         page_num = list(page_num)
 
-        addr = self.globals["NEW_APP_START"]
+        addr = self.globals["NEW_APP_START"] + start_page*PAGE_SIZE
         addr = addr.to_bytes(4, 'big')
         addr = list(addr)
 
@@ -215,84 +622,169 @@ class Iap:
             check_sum ^= x
 
         _send_data = [IAP_CMD_START, IAP_CMD_EARSE, check_sum, _len] + addr + page_num + [IAP_CMD_END]
+        return _send_data
 
-        for _ in range(IAP_RETRY_TIMES):
-            self.boot_i2c._write_block_data(_send_data[0], _send_data[1:])
-            _st = time.time()
-            status = IAP_NACK_ERR
-            while time.time() - _st < 5:
-                try:
-                    status = self.boot_i2c._read_byte()
-                    break
-                except TimeoutError:
-                    pass
-                except OSError:
-                    pass
-                time.sleep(0.01)
-            
-            # print(f"\nearse status: {status:#02x}")
-            # print(f"page_num: {page_num}")
-            if status == IAP_OK:
-                return True
-        else:
-            return False
+    def earse_flash(self, file_size, start_page=0):
+        _send_data = self.build_erase_frame(file_size, start_page)
+        status = self.retry.run(lambda: self._send_frame(_send_data, self._timeout("ERASE")), self.stats)
+        return status == IAP_OK
 
-    def burn_data(self, ui_obj, data, data_offset):
+    def build_write_frame(self, data, data_offset):
         # | start | cmd | checksum | len  | data_offset    | data | end |
         # | ----- | --- | -------- | ---- | -------------- | ---- | --- |
         # | 0     | 1   | 2        | 3    | 4~5（u16,Big） | 6... | -1  |
-        check_sum = 0
-        
-        # 4 bytes aligned
-        data_len = len(data) 
-        if data_len % 4 != 0:
-            data += [0xFF]*(4-(data_len%4))
-
-        #
+        # the frame is built in a reusable buffer, the returned view is
+        # only valid until the next call
         data_len = len(data)
-        _len = data_len + 2 # data_offset + data
-
-        data_offset = data_offset.to_bytes(2, 'big')
-        data_offset = list(data_offset)
-        
-        for x in data_offset:
-            check_sum ^= x
-        for x in data:
-            check_sum ^= x
-
-        _send_data = [IAP_CMD_START, IAP_CMD_WRITE, check_sum, _len] + data_offset + data + [IAP_CMD_END]
-        ui_obj.clear_xline(ui_obj._height)
-        ui_obj.clear_xline(ui_obj._height+1)
-        _send_data_hex = ""
-        for x in _send_data:
-            _send_data_hex += f"{x:02X}, "
-        _send_data_hex = _send_data_hex[:-2]
-        ui_obj.draw(f"send_data: {_send_data_hex}", location=(0, ui_obj._height-1))
-
-        status = IAP_NACK_ERR 
-        for _ in range(IAP_RETRY_TIMES):
-            self.boot_i2c._write_block_data(_send_data[0], _send_data[1:])
-            _st = time.time()
-            status = IAP_NACK_ERR
-            while time.time() - _st < 5:
-                try:
-                    status = self.boot_i2c._read_byte()
-                    break
-                except TimeoutError:
-                    pass
-                except OSError:
-                    pass
-                time.sleep(0.01)
-
-            # print(f"\nburn status: {status:#02x}")
+        pad = -data_len % 4 # 4 bytes aligned
+        end = 6 + data_len + pad
+
+        frame = self._frame
+        frame[0] = IAP_CMD_START
+        frame[1] = IAP_CMD_WRITE
+        frame[3] = data_len + pad + 2 # data_offset + data
+        frame[4] = (data_offset >> 8) & 0xFF
+        frame[5] = data_offset & 0xFF
+        frame[6:6+data_len] = data
+        frame[6+data_len:end] = b'\xff'*pad
+        frame[end] = IAP_CMD_END
+
+        frame[2] = xor_checksum(self._frame_view[4:end])
+
+        _send_data = self._frame_view[:end+1]
+        if self.verbose:
+            self._debug("send_data: " + ", ".join(f"{x:02X}" for x in _send_data))
+        return _send_data
+
+    def encode(self, image):
+        # encoded WRITE frames of the image at the current data_len, cached
+        return frame_cache.get(image, self.data_len)
+
+    def burn_frame(self, frame):
+        # send an already encoded WRITE frame, return its status
+        if self.verbose:
+            self._debug("send_data: " + ", ".join(f"{x:02X}" for x in frame))
+        return self._send_frame(frame, self._timeout("WRITE"))
+
+    def burn_data(self, data, data_offset):
+        # burn one frame, resent while its status is retryable
+        _send_data = self.build_write_frame(data, data_offset)
+        return self.retry.run(lambda: self._send_frame(_send_data, self._timeout("WRITE")), self.stats)
+
+    def _write_frame(self, frame):
+        # write a frame without waiting for its status
+        try:
+            self.boot_i2c._write_block_data(frame[0], frame[1:])
+            return True
+        except OSError:
+            return False
 
-            # if status == IAP_OK:
-            #     return True
-            return status
-        else:
-            return status
-        
-    def verify_data(self, data):
+    def _read_status(self, timeout=IAP_TIMEOUT):
+        _st = time.time()
+        status = self.waiter.wait(self.boot_i2c._read_byte, timeout)
+        self.stats.add_ack(time.time() - _st)
+        if status is None:
+            return IAP_NACK_ERR
+        return status
+
+    def burn_windowed(self, image, window, on_progress=None):
+        # send `window` frames back to back, then collect their statuses in order.
+        # frames that failed are resent one by one by data_offset (stop-and-wait)
+        if not isinstance(image, FirmwareImage):
+            image = FirmwareImage(image)
+        data_len = len(image)
+        frames = self.encode(image).frames
+        for i in range(0, len(frames), window):
+            batch = frames[i:i+window]
+            sent = [self._write_frame(frame) for _, frame in batch]
+            failed = []
+            for (data_offset, frame), is_sent in zip(batch, sent):
+                status = self._read_status(self._timeout("WRITE")) if is_sent else IAP_NACK_ERR
+                if status != IAP_OK:
+                    failed.append((frame, status))
+            for frame, status in failed:
+                status = self.retry.run(lambda: self.burn_frame(frame), self.stats, status)
+                if status != IAP_OK:
+                    return status
+            if on_progress is not None:
+                on_progress(min(batch[-1][0] + self.data_len, data_len), data_len)
+        return IAP_OK
+
+    def burn(self, image, on_progress=None):
+        # burn the whole image, return the status of the last frame.
+        # IAP_WINDOW_SIZE > 1 pipelines frames on bootloaders that support it
+        if not isinstance(image, FirmwareImage):
+            image = FirmwareImage(image)
+        window = self.globals.get("IAP_WINDOW_SIZE", 1)
+        if window > 1:
+            return self.burn_windowed(image, window, on_progress)
+
+        data_len = len(image)
+        status = IAP_OK
+        for data_offset, frame in self.encode(image).frames:
+            status = self.retry.run(lambda: self.burn_frame(frame), self.stats)
+            if status != IAP_OK:
+                break
+            if on_progress is not None:
+                on_progress(min(data_offset + self.data_len, data_len), data_len)
+        return status
+
+    def burn_incremental(self, image, previous, on_progress=None):
+        # erase and burn only the pages that differ from `previous`. Every page
+        # that is skipped is checked on the device with its own VERIFY first.
+        # return None when one doesn't match, the caller then burns in full
+        if not isinstance(image, FirmwareImage):
+            image = FirmwareImage(image)
+        if not previous:
+            return None
+        data_len = len(image)
+        pages = changed_pages(previous, image.data)
+        unchanged = [page for page in range((data_len + PAGE_SIZE - 1) // PAGE_SIZE) if page not in pages]
+        if not self.verify_pages(image.data, unchanged):
+            return None
+        runs = page_runs(pages)
+        total = sum(min(page_num*PAGE_SIZE, data_len - start_page*PAGE_SIZE) for start_page, page_num in runs)
+        done = 0
+        for start_page, page_num in runs:
+            if not self.earse_flash(page_num*PAGE_SIZE, start_page):
+                return IAP_FLASH_ERR
+            run_start = start_page*PAGE_SIZE
+            run_end = min(run_start + page_num*PAGE_SIZE, data_len)
+            for data_offset, payload in image.frames(self.data_len, run_start, run_end):
+                status = self.burn_data(payload, data_offset)
+                if status != IAP_OK:
+                    return status
+                done += min(self.data_len, run_end - data_offset)
+                if on_progress is not None:
+                    on_progress(done, total)
+        return IAP_OK
+
+    def resume_burn(self, image, offset, on_progress=None):
+        # continue a burn interrupted after the first `offset` bytes (page aligned)
+        # were acknowledged. The device must still be in boot mode and hold that
+        # prefix, checked with a VERIFY per page (see verify_pages, a whole prefix
+        # VERIFY passes on an erased board when the prefix xor is 0). Pages from
+        # offset on are erased again, frames past the checkpoint may have been
+        # written already.
+        # return None when it can't resume, the caller then burns in full
+        if not isinstance(image, FirmwareImage):
+            image = FirmwareImage(image)
+        data_len = len(image)
+        if offset <= 0 or offset % PAGE_SIZE != 0 or offset >= data_len:
+            return None
+        if not self.check_boot_mode() or not self.verify_pages(image.data, range(offset // PAGE_SIZE)):
+            return None
+        if not self.earse_flash(data_len - offset, offset // PAGE_SIZE):
+            return IAP_FLASH_ERR
+        for data_offset, payload in image.frames(self.data_len, offset):
+            status = self.burn_data(payload, data_offset)
+            if status != IAP_OK:
+                return status
+            if on_progress is not None:
+                on_progress(min(data_offset + self.data_len, data_len), data_len)
+        return IAP_OK
+
+    def build_verify_frame(self, data, start=0):
         # | start | cmd | checksum | len | addr          | size          | flash_checksum | end |
         # | ----- | --- | -------- | --- | ------------- | ------------- | -------------- | --- |
         # | 0     | 1   | 2        | 3   | 4~7 (u32,Big) | 8~9 (u16,Big) | 10             | 11  |
@@ -300,16 +792,18 @@ class Iap:
         _len = 7 # addr + size + flash_checksum
 
         # addr
-        addr = self.globals["NEW_APP_START"]
+        addr = self.globals["NEW_APP_START"] + start
         addr = addr.to_bytes(4, 'big')
         addr = list(addr)
         # size
-        firmware_check_sum = 0
         firmware_size = len(data).to_bytes(2, 'big')
         firmware_size = list(firmware_size)
         # flash_checksum
-        for x in data:
-            firmware_check_sum ^= x
+        if isinstance(data, FirmwareImage):
+            # folded by the encoder while building the WRITE frames, no second pass
+            firmware_check_sum = self.encode(data).checksum
+        else:
+            firmware_check_sum = xor_checksum(data)
         # checksum
         for x in addr:
             check_sum ^= x
@@ -318,17 +812,39 @@ class Iap:
         check_sum ^= firmware_check_sum
         #
         _send_data = [IAP_CMD_START, IAP_CMD_VERIFY, check_sum, _len] + addr + firmware_size + [firmware_check_sum] + [IAP_CMD_END]
-        self.boot_i2c._write_block_data(_send_data[0], _send_data[1:])
-        status = self.boot_i2c._read_byte()
+        return _send_data
+
+    def verify_data(self, data, start=0):
+        _send_data = self.build_verify_frame(data, start)
+        # a mismatch is IAP_FAIL, not resent
+        status = self.retry.run(lambda: self._send_frame(_send_data, self._timeout("VERIFY")), self.stats)
         if status == IAP_OK:
             return True
         else:
             return False
 
+    def verify_pages(self, data, pages):
+        # VERIFY `data` on the device one page at a time. When a page has the
+        # same xor as an erased one (0xFF for an odd size, 0 for an even one),
+        # the bytes up to its first non 0xFF byte are verified as well, which an
+        # erased page never matches
+        data = bytes(data)
+        for page in pages:
+            start = page*PAGE_SIZE
+            chunk = data[start:start+PAGE_SIZE]
+            if not self.verify_data(chunk, start):
+                return False
+            if xor_checksum(chunk) == (0xFF if len(chunk) % 2 else 0):
+                i = next((i for i, x in enumerate(chunk) if x != 0xFF), None)
+                if i is not None and not self.verify_data(chunk[:i+1], start):
+                    return False
+        return True
+
     def restore_factory_firmware(self):
         # | start | cmd | value | end |
         # | ----- | --- | ------| --- |
         # | 0     | 1   | 2     | 3   |
+        self.mode.invalidate()
         for _ in range(IAP_RETRY_TIMES):
             self.boot_i2c._write_block_data(IAP_CMD_START, [IAP_CMD_RST_FACTORY, 1, IAP_CMD_END])
             status = self.boot_i2c._read_byte()
@@ -0,0 +1,79 @@
+from .iap import IAP_OK, APP_MODE, BOOT_MODE, firmware_is_current
+from .firmware import FirmwareCache, FirmwareImage, BurnCheckpoint, FIRMWARE_CACHE_DIR
+
+# =============================================================
+# Update sequence of one board, shared by the command line and
+# fleet flashing. Results are dicts with "ok" and, on failure,
+# "error".
+
+ERROR_NO_DEVICE = "device not found"
+
+
+def failed(result, error):
+    result["ok"] = False
+    result["error"] = error
+    return result
+
+
+def ensure_boot_mode(iap):
+    if iap.check_boot_mode():
+        return True
+    if iap.get_mode() != APP_MODE:
+        return False
+    return iap.enter_boot_mode()
+
+
+def flash_image(iap, data, result, full=False, reset=True, on_progress=None, version=None, force=False,
+                incremental=None):
+    # enter boot, burn (resumed, or incremental if asked, when possible), verify and reset.
+    # skipped when the device already runs `version`, unless force.
+    # incremental None follows IAP_INCREMENTAL
+    if incremental is None:
+        incremental = iap.globals.get("IAP_INCREMENTAL", False)
+    mode = iap.get_mode()
+    if mode is None:
+        return failed(result, ERROR_NO_DEVICE)
+    image = data if isinstance(data, FirmwareImage) else FirmwareImage(data)
+    cache_dir = iap.globals.get("FIRMWARE_CACHE_DIR", FIRMWARE_CACHE_DIR)
+    cache = FirmwareCache(cache_dir, bus=iap.bus, mux_channel=iap.mux_channel)
+    checkpoint = BurnCheckpoint(cache_dir, bus=iap.bus, mux_channel=iap.mux_channel)
+    if not force and firmware_is_current(iap.read_device_info(), version, image.checksum, cache.load()):
+        result["skipped"] = True
+        result["ok"] = True
+        return result
+
+    if not ensure_boot_mode(iap):
+        return failed(result, "entering bootloader failed")
+
+    iap.negotiate_data_len()
+
+    status = None
+    # an interrupted burn of the same image, only if the device stayed in boot mode
+    offset = checkpoint.load(image.sha256)
+    if not full and offset is not None and mode == BOOT_MODE:
+        status = iap.resume_burn(image, offset, on_progress=checkpoint.track(image.sha256, on_progress))
+        if status is not None:
+            result["resumed"] = offset
+    if status is None and incremental and not full:
+        status = iap.burn_incremental(image, cache.load(), on_progress=on_progress)
+        result["incremental"] = status is not None
+    if status is None:
+        cache.clear()
+        checkpoint.clear()
+        if not iap.earse_flash(len(image)):
+            return failed(result, "erase flash failed")
+        status = iap.burn(image, on_progress=checkpoint.track(image.sha256, on_progress))
+    if status != IAP_OK:
+        return failed(result, f"burn failed 0x{status:02x}")
+
+    if not iap.verify_data(image):
+        cache.clear()
+        checkpoint.clear()
+        return failed(result, "verify failed")
+    cache.save(image.data)
+    checkpoint.clear()
+
+    if reset:
+        result["reset"] = iap.reset_device()
+    result["ok"] = True
+    return result
@@ -0,0 +1,342 @@
+import time
+import errno
+import random
+from collections import deque
+
+from .iap import *
+
+# =============================================================
+# In-process Fusion HAT simulator, for testing and timing Iap
+# without hardware. SimulatedFusionHat models the app mode
+# registers, the ADV_CMD commands and the bootloader IAP
+# commands, backed by a flash bytearray. SimulatedI2C exposes
+# it through the same interface as I2C.
+#
+#   device = SimulatedFusionHat(Fusion_HAT_Globals, bus_speed=100000)
+#   iap = device.iap()
+
+
+def xor_sum(data):
+    check_sum = 0
+    for x in data:
+        check_sum ^= x
+    return check_sum
+
+
+class SimulatedFusionHat:
+    BOOT_VERSION = (1, 0, 0)
+    FACTORY_VERSION = (1, 0, 0)
+
+    def __init__(self,
+                 globals,
+                 firmware=None,
+                 factory_firmware=None,
+                 app_version=(1, 1, 4),
+                 mode=APP_MODE,
+                 bus_speed=100000,
+                 latency=0.0,
+                 detach_delay=0.2,
+                 boot_delay=0.5,
+                 write_time=0.0,
+                 erase_time=0.0,
+                 max_data_len=None,
+                 pipeline_depth=1,
+                 checksum_error_rate=0.0,
+                 nack_writes=(),
+                 seed=None):
+        self.globals = globals
+        self.app_version = tuple(app_version)
+        self.bus_speed = bus_speed              # Hz, used to time every transfer
+        self.latency = latency                  # seconds added to every transfer
+        self.detach_delay = detach_delay        # seconds still answering at the old address after a switch
+        self.boot_delay = boot_delay            # seconds to re-enumerate at the new address
+        self.write_time = write_time            # seconds busy after a WRITE frame
+        self.erase_time = erase_time            # seconds busy per erased page
+        self.max_data_len = max_data_len        # largest WRITE payload accepted, None for no limit
+        self.pipeline_depth = pipeline_depth    # > 1 queues statuses for windowed burns
+        self.checksum_error_rate = checksum_error_rate
+        self.nack_writes = set(nack_writes)     # WRITE frames NACKed on the bus, by number from 1
+        self._random = random.Random(seed)
+
+        self.flash_size = self.globals["FIRMWARE_MAX_BYTES"]
+        self.flash = bytearray(b'\xff'*self.flash_size)
+        if firmware is not None:
+            self.flash[:len(firmware)] = firmware
+        self.factory_firmware = bytes(factory_firmware) if factory_firmware is not None else None
+
+        self._mode = mode
+        self._transition = None # (new mode, detach time, attach time)
+        self._busy_until = 0
+        self._status = IAP_NACK_ERR
+        self._statuses = deque()
+
+        # statistics
+        self.transfers = 0
+        self.bytes_transferred = 0
+        self.frames = {}
+        self.checksum_errors = 0
+        self.write_frames = 0
+        self.write_nacks = 0
+
+    # ---------------------------------------------------------
+    def i2c(self, addr, block_max=None):
+        return SimulatedI2C(self, addr, block_max=block_max)
+
+    def iap(self, globals=None, block_max=None, **kwargs):
+        # block_max emulates the transport limit, 32 for smbus, larger for rdwr.
+        # transition latencies stay in memory, not mixed with a real board's
+        if globals is None:
+            globals = self.globals
+        kwargs.setdefault("transition", TransitionWaiter())
+        return Iap(globals,
+                   app_i2c=self.i2c(self.globals["APP_I2C_ADDR"], block_max),
+                   boot_i2c=self.i2c(self.globals["BOOT_I2C_ADDR"], block_max),
+                   **kwargs)
+
+    @property
+    def mode(self):
+        if self._transition is None:
+            return self._mode
+        new_mode, detach_time, attach_time = self._transition
+        now = time.time()
+        if now >= attach_time:
+            self._mode = new_mode
+            self._transition = None
+            return self._mode
+        elif now >= detach_time:
+            return None
+        return self._mode
+
+    def _switch_mode(self, mode):
+        self._statuses.clear()
+        now = time.time()
+        self._transition = (mode, now + self.detach_delay, now + max(self.boot_delay, self.detach_delay))
+
+    def address_mode(self, addr):
+        if addr == self.globals["APP_I2C_ADDR"]:
+            return APP_MODE
+        elif addr == self.globals["BOOT_I2C_ADDR"]:
+            return BOOT_MODE
+        return None
+
+    # ---------------------------------------------------------
+    # bus
+    def transfer(self, addr, num_bytes):
+        # one i2c transaction: start, address, data, 9 clocks per byte
+        self.transfers += 1
+        self.bytes_transferred += num_bytes
+        delay = self.latency + (num_bytes + 1)*9/self.bus_speed
+        if delay > 0:
+            time.sleep(delay)
+        if self.address_mode(addr) is None or self.address_mode(addr) != self.mode:
+            raise OSError(errno.EREMOTEIO, "Remote I/O error")
+
+    def is_nacked(self, reg, data):
+        # a WRITE frame listed in nack_writes is lost on the bus, never reaching the bootloader
+        if self.mode != BOOT_MODE or reg != IAP_CMD_START or len(data) == 0 or data[0] != IAP_CMD_WRITE:
+            return False
+        self.write_frames += 1
+        if self.write_frames in self.nack_writes:
+            self.write_nacks += 1
+            return True
+        return False
+
+    def set_status(self, status):
+        if self.pipeline_depth > 1:
+            self._statuses.append(status)
+            while len(self._statuses) > self.pipeline_depth:
+                self._statuses.popleft()
+        self._status = status
+
+    def read_status(self):
+        if time.time() < self._busy_until:
+            raise OSError(errno.EAGAIN, "Device busy")
+        if self._statuses:
+            return self._statuses.popleft()
+        return self._status
+
+    # ---------------------------------------------------------
+    # registers
+    def app_registers(self):
+        regs = bytearray(256)
+        board_id = self.globals["BOARD_ID_REG_ADDR"]
+        regs[board_id:board_id+2] = (1908).to_bytes(2, 'big')
+        self._put(regs, "APP_VERSION_REG_ADDR", self.app_version)
+        self._put(regs, "BOOT_VERSION_REG_ADDR", self.BOOT_VERSION)
+        self._put(regs, "FACTORY_VERSION_REG_ADDR", self.FACTORY_VERSION)
+        self._put(regs, "MIAN_ENTRY_REG_ADDR", self.main_entry())
+        return regs
+
+    def boot_registers(self):
+        regs = bytearray(256)
+        self._put(regs, "BOOT_VERSION_REG_ADDR_BOOT", self.BOOT_VERSION)
+        self._put(regs, "FACTORY_VERSION_REG_ADDR_BOOT", self.FACTORY_VERSION)
+        self._put(regs, "APP_VERSION_REG_ADDR_BOOT", self.app_version)
+        self._put(regs, "BOOT_MODE_BOOT", [self.globals["UPGRADE_MODE"]])
+        self._put(regs, "MIAN_ENTRY_REG_ADDR_BOOT", self.main_entry())
+        reg = self.globals.get("IAP_MAX_DATA_LEN_REG_ADDR_BOOT")
+        if reg is not None and self.max_data_len is not None:
+            regs[reg:reg+2] = self.max_data_len.to_bytes(2, 'big')
+        return regs
+
+    def _put(self, regs, name, values):
+        reg = self.globals[name]
+        regs[reg:reg+len(values)] = bytes(values)
+
+    def main_entry(self):
+        return list(self.globals["NEW_APP_START"].to_bytes(4, 'big'))
+
+    def read_registers(self, reg, num):
+        if self.mode == APP_MODE:
+            regs = self.app_registers()
+        else:
+            regs = self.boot_registers()
+        return list(regs[reg:reg+num])
+
+    # ---------------------------------------------------------
+    # commands
+    def write(self, reg, data):
+        data = list(data)
+        if self.mode == APP_MODE:
+            if reg == ADV_CMD_START:
+                self.adv_command(data)
+            return
+        if reg != IAP_CMD_START or len(data) < 2:
+            self.set_status(IAP_DATA_ERR)
+            return
+        cmd = data[0]
+        self.frames[cmd] = self.frames.get(cmd, 0) + 1
+        if data[-1] != IAP_CMD_END:
+            self.set_status(IAP_DATA_ERR)
+        elif cmd == IAP_CMD_ACK:
+            self.set_status(IAP_OK)
+        elif cmd == IAP_CMD_RST:
+            self.set_status(IAP_OK)
+            self._switch_mode(APP_MODE)
+        elif cmd == IAP_CMD_RST_FACTORY:
+            self.restore_factory()
+        elif cmd in (IAP_CMD_EARSE, IAP_CMD_WRITE, IAP_CMD_VERIFY):
+            check_sum, _len, payload = data[1], data[2], data[3:-1]
+            if _len != len(payload):
+                self.set_status(IAP_SIZE_ERR)
+            elif xor_sum(payload) != check_sum or self._random.random() < self.checksum_error_rate:
+                self.checksum_errors += 1
+                self.set_status(IAP_CHECKSUM_ERR)
+            elif cmd == IAP_CMD_EARSE:
+                self.erase(payload)
+            elif cmd == IAP_CMD_WRITE:
+                self.program(payload)
+            else:
+                self.verify(payload)
+        else:
+            self.set_status(IAP_FAIL)
+
+    def adv_command(self, data):
+        if len(data) != 3 or data[-1] != ADV_CMD_END:
+            self._status = ADV_CMD_ERR
+            return
+        cmd = data[0]
+        if cmd == ADV_CMD_ENTER_BOOT:
+            self._status = ADV_CMD_OK
+            self._switch_mode(BOOT_MODE)
+        elif cmd == ADV_CMD_RST:
+            self._status = ADV_CMD_OK
+            self._switch_mode(APP_MODE)
+        else:
+            self._status = ADV_CMD_ERR
+
+    def _flash_offset(self, addr):
+        return addr - self.globals["NEW_APP_START"]
+
+    def erase(self, payload):
+        # addr(u32, Big), page_num(u16, Big)
+        offset = self._flash_offset(int.from_bytes(bytes(payload[0:4]), 'big'))
+        page_num = int.from_bytes(bytes(payload[4:6]), 'big')
+        if offset < 0 or offset % PAGE_SIZE != 0 or offset + page_num*PAGE_SIZE > self.flash_size:
+            self.set_status(IAP_FLASH_ERR)
+            return
+        self.flash[offset:offset+page_num*PAGE_SIZE] = b'\xff'*(page_num*PAGE_SIZE)
+        self._busy_until = time.time() + self.erase_time*page_num
+        self.set_status(IAP_OK)
+
+    def program(self, payload):
+        # data_offset(u16, Big), data
+        offset = int.from_bytes(bytes(payload[0:2]), 'big')
+        data = payload[2:]
+        if len(data) % 4 != 0:
+            self.set_status(IAP_4BYTES_ALIGN_ERR)
+        elif self.max_data_len is not None and len(data) > self.max_data_len:
+            self.set_status(IAP_SIZE_ERR)
+        elif offset + len(data) > self.flash_size:
+            self.set_status(IAP_SIZE_ERR)
+        elif any(x != 0xFF for x in self.flash[offset:offset+len(data)]):
+            # flash can only be programmed after an erase
+            self.set_status(IAP_FLASH_ERR)
+        else:
+            self.flash[offset:offset+len(data)] = bytes(data)
+            self._busy_until = time.time() + self.write_time
+            self.set_status(IAP_OK)
+
+    def verify(self, payload):
+        # addr(u32, Big), size(u16, Big), flash_checksum
+        offset = self._flash_offset(int.from_bytes(bytes(payload[0:4]), 'big'))
+        size = int.from_bytes(bytes(payload[4:6]), 'big')
+        if offset < 0 or offset + size > self.flash_size:
+            self.set_status(IAP_SIZE_ERR)
+        elif xor_sum(self.flash[offset:offset+size]) != payload[6]:
+            self.set_status(IAP_FAIL)
+        else:
+            self.set_status(IAP_OK)
+
+    def restore_factory(self):
+        if self.factory_firmware is None:
+            self.set_status(IAP_FAIL)
+            return
+        self.flash[:] = b'\xff'*self.flash_size
+        self.flash[:len(self.factory_firmware)] = self.factory_firmware
+        self.app_version = self.FACTORY_VERSION
+        self.set_status(IAP_OK)
+
+
+class SimulatedI2C:
+    BLOCK_MAX = 32
+
+    def __init__(self, device, addr, block_max=None):
+        self.device = device
+        self._addr = addr
+        self._bus = None
+        if block_max is not None:
+            self.BLOCK_MAX = block_max
+
+    def close(self):
+        pass
+
+    def _check_len(self, num):
+        if num > self.BLOCK_MAX:
+            raise ValueError("Data length cannot exceed {} bytes".format(self.BLOCK_MAX))
+
+    def _write_byte(self, data):
+        self.device.transfer(self._addr, 1)
+
+    def _write_block_data(self, reg, data):
+        self._check_len(len(data))
+        self.device.transfer(self._addr, len(data) + 1)
+        if self.device.is_nacked(reg, data):
+            raise OSError(errno.EREMOTEIO, "Remote I/O error")
+        self.device.write(reg, data)
+
+    def _read_byte(self):
+        self.device.transfer(self._addr, 1)
+        return self.device.read_status()
+
+    def _read_block_data(self, reg, num):
+        self._check_len(num)
+        self.device.transfer(self._addr, num + 1)
+        return self.device.read_registers(reg, num)
+
+    def is_ready(self):
+        try:
+            self.device.transfer(self._addr, 1)
+            return True
+        except OSError:
+            return False
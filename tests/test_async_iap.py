@@ -0,0 +1,57 @@
+import asyncio
+import random
+import unittest
+
+from globals.fusion_hat_globals import Fusion_HAT_Globals
+from i2c_iap_tool.iap import IAP_OK, IAP_CHECKSUM_ERR, IAP_NACK_ERR, BOOT_MODE
+from i2c_iap_tool.async_iap import AsyncIap
+from i2c_iap_tool.simulator import SimulatedFusionHat
+
+# =============================================================
+# AsyncIap against SimulatedFusionHat, it follows the same
+# retry and transition policies as Iap
+
+FAST = dict(bus_speed=10**9, detach_delay=0.15, boot_delay=0.2)
+
+
+def firmware(size, seed=0):
+    return bytes(random.Random(seed).getrandbits(8) for _ in range(size))
+
+
+class AsyncIapTest(unittest.TestCase):
+    def device(self, globals=None, **kwargs):
+        device = SimulatedFusionHat(dict(Fusion_HAT_Globals, **(globals or {})), **dict(FAST, **kwargs))
+        return device, AsyncIap(device.iap())
+
+    def test_burn_resends(self):
+        data = firmware(5000)
+        device, aiap = self.device(mode=BOOT_MODE, checksum_error_rate=0.1, nack_writes=[10], seed=1)
+
+        async def flash():
+            self.assertTrue(await aiap.earse_flash(len(data)))
+            self.assertEqual(await aiap.burn(data), IAP_OK)
+            self.assertTrue(await aiap.verify(data))
+        asyncio.run(flash())
+        self.assertEqual(bytes(device.flash[:len(data)]), data)
+        self.assertEqual(aiap.iap.stats.retry_statuses.get(IAP_NACK_ERR), 1)
+        self.assertGreater(aiap.iap.stats.retry_statuses.get(IAP_CHECKSUM_ERR, 0), 0)
+
+    def test_no_retry(self):
+        # IAP_RETRY_TIMES 0 still makes the one attempt, as RetryPolicy.run
+        device, aiap = self.device({"IAP_RETRY_TIMES": 0}, mode=BOOT_MODE, nack_writes=[1])
+
+        async def flash():
+            self.assertTrue(await aiap.earse_flash(100))
+            return await aiap.burn_data(bytes(24), 0)
+        self.assertEqual(asyncio.run(flash()), IAP_NACK_ERR)
+        self.assertEqual(aiap.iap.stats.retries, 0)
+
+    def test_enter_boot_mode(self):
+        device, aiap = self.device()
+        self.assertTrue(asyncio.run(aiap.enter_boot_mode()))
+        self.assertEqual(device.mode, BOOT_MODE)
+        self.assertIn(BOOT_MODE, aiap.iap.transition.latencies)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,204 @@
+import io
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from globals.fusion_hat_globals import Fusion_HAT_Globals
+from i2c_iap_tool.iap import IAP_OK, IAP_NACK_ERR, BOOT_MODE, PAGE_SIZE, TransitionWaiter
+from i2c_iap_tool.firmware import FirmwareCache, FirmwareImage, TransitionCache
+from i2c_iap_tool.session import flash_image
+from i2c_iap_tool.fleet import interleave_burn, FleetProgress
+from i2c_iap_tool.cli import ProgressLine
+from i2c_iap_tool.simulator import SimulatedFusionHat, xor_sum
+
+# =============================================================
+# Burn paths driven through SimulatedFusionHat, no hardware needed
+#
+#   python3 -m pytest tests
+
+FAST = dict(bus_speed=10**9, detach_delay=0.15, boot_delay=0.2)
+
+
+def firmware(size, seed=0):
+    return bytes(random.Random(seed).getrandbits(8) for _ in range(size))
+
+
+class SimulatorTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.globals = dict(Fusion_HAT_Globals, FIRMWARE_CACHE_DIR=self.cache_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def boot_device(self, **kwargs):
+        # a device already in boot mode and its negotiated Iap
+        device = SimulatedFusionHat(self.globals, mode=BOOT_MODE, **dict(FAST, **kwargs))
+        iap = device.iap()
+        iap.negotiate_data_len()
+        return device, iap
+
+    def save_cache(self, iap, data):
+        FirmwareCache(self.cache_dir, bus=iap.bus, mux_channel=iap.mux_channel).save(data)
+
+    # ---------------------------------------------------------
+    # verify
+    def test_verify_checksum(self):
+        # odd sizes pad the last WRITE payload with 0xFF
+        for size in (5000, 5001, 5002, 5003):
+            data = firmware(size, seed=size)
+            device, iap = self.boot_device()
+            self.assertTrue(iap.earse_flash(len(data)))
+            self.assertEqual(iap.burn(data), IAP_OK)
+            self.assertEqual(iap.encode(FirmwareImage(data)).checksum, xor_sum(data))
+            self.assertTrue(iap.verify_data(FirmwareImage(data)))
+            self.assertTrue(iap.verify_data(list(data)))
+
+    # ---------------------------------------------------------
+    # mode transition
+    def test_transition_latency_outlives_session(self):
+        device = SimulatedFusionHat(self.globals, **FAST)
+        iap = device.iap(transition=TransitionWaiter(cache=TransitionCache(self.cache_dir)))
+        self.assertTrue(iap.enter_boot_mode())
+        # the ACK probes are not frames of the update
+        self.assertEqual(iap.stats.frames, 0)
+        latency = iap.transition.latencies[BOOT_MODE]
+        # a new session on the same bus and channel starts with it
+        iap = device.iap(transition=TransitionWaiter(cache=TransitionCache(self.cache_dir)))
+        self.assertAlmostEqual(iap.transition.latencies[BOOT_MODE], latency)
+        self.assertGreater(iap.transition.headstart(BOOT_MODE), 0)
+
+    # ---------------------------------------------------------
+    # retry
+    def test_checksum_errors_are_resent(self):
+        data = firmware(5000)
+        device, iap = self.boot_device(checksum_error_rate=0.2, seed=1)
+        self.assertTrue(iap.earse_flash(len(data)))
+        self.assertEqual(iap.burn(data), IAP_OK)
+        self.assertTrue(iap.verify_data(data))
+        self.assertEqual(bytes(device.flash[:len(data)]), data)
+        self.assertGreater(device.checksum_errors, 0)
+        self.assertGreater(iap.stats.retries, 0)
+
+    def test_nacked_write_is_resent(self):
+        data = firmware(5000)
+        device, iap = self.boot_device(nack_writes=[10])
+        self.assertTrue(iap.earse_flash(len(data)))
+        self.assertEqual(iap.burn(data), IAP_OK)
+        self.assertEqual(device.write_nacks, 1)
+        self.assertEqual(iap.stats.retry_statuses.get(IAP_NACK_ERR), 1)
+        self.assertEqual(bytes(device.flash[:len(data)]), data)
+
+    # ---------------------------------------------------------
+    # windowed
+    def test_windowed_burn(self):
+        self.globals["IAP_WINDOW_SIZE"] = 4
+        data = firmware(5000)
+        device, iap = self.boot_device(pipeline_depth=4, checksum_error_rate=0.1, nack_writes=[10], seed=2)
+        self.assertTrue(iap.earse_flash(len(data)))
+        self.assertEqual(iap.burn(data), IAP_OK)
+        self.assertEqual(device.write_nacks, 1)
+        self.assertEqual(bytes(device.flash[:len(data)]), data)
+
+    # ---------------------------------------------------------
+    # incremental
+    def test_incremental_is_opt_in(self):
+        old = firmware(5000)
+        new = bytearray(old)
+        new[4500] ^= 0x5A
+        device = SimulatedFusionHat(self.globals, firmware=old, **FAST)
+        iap = device.iap()
+        self.save_cache(iap, old)
+        result = flash_image(iap, bytes(new), {}, force=True)
+        self.assertTrue(result["ok"])
+        self.assertNotIn("incremental", result)
+        self.assertEqual(bytes(device.flash[:len(new)]), bytes(new))
+
+    def test_incremental_burns_changed_pages(self):
+        old = firmware(5000)
+        new = bytearray(old)
+        new[4500] ^= 0x5A
+        device = SimulatedFusionHat(self.globals, firmware=old, **FAST)
+        iap = device.iap()
+        self.save_cache(iap, old)
+        result = flash_image(iap, bytes(new), {}, force=True, incremental=True)
+        self.assertTrue(result["ok"])
+        self.assertTrue(result["incremental"])
+        self.assertLess(device.write_frames, (len(new) - 4*PAGE_SIZE) // iap.data_len + 2)
+        self.assertEqual(bytes(device.flash[:len(new)]), bytes(new))
+
+    def test_incremental_tampered_board(self):
+        # two pages changed on the board with the same whole image xor
+        old = firmware(5000)
+        new = bytearray(old)
+        new[4500] ^= 0x5A
+        device = SimulatedFusionHat(self.globals, firmware=old, **FAST)
+        device.flash[1100] ^= 0x33
+        device.flash[2200] ^= 0x33
+        self.assertEqual(xor_sum(device.flash[:len(old)]), xor_sum(old))
+        iap = device.iap()
+        self.save_cache(iap, old)
+        result = flash_image(iap, bytes(new), {}, force=True, incremental=True)
+        self.assertTrue(result["ok"])
+        self.assertFalse(result["incremental"])
+        self.assertEqual(bytes(device.flash[:len(new)]), bytes(new))
+
+    # ---------------------------------------------------------
+    # resume
+    def prefix_xor_zero(self, size, pages):
+        # every page of the prefix has xor 0, like an erased page of even size
+        data = bytearray(firmware(size))
+        for page in range(pages):
+            start = page*PAGE_SIZE
+            data[start+PAGE_SIZE-1] ^= xor_sum(data[start:start+PAGE_SIZE])
+        return bytes(data)
+
+    def test_resume_burn(self):
+        data = self.prefix_xor_zero(5000, 2)
+        device, iap = self.boot_device()
+        device.flash[:2*PAGE_SIZE] = data[:2*PAGE_SIZE]
+        device.flash[2*PAGE_SIZE:2*PAGE_SIZE+100] = data[2*PAGE_SIZE:2*PAGE_SIZE+100]
+        self.assertEqual(iap.resume_burn(data, 2*PAGE_SIZE), IAP_OK)
+        self.assertEqual(bytes(device.flash[:len(data)]), data)
+
+    def test_resume_rejects_erased_board(self):
+        data = self.prefix_xor_zero(5000, 2)
+        device, iap = self.boot_device()
+        # a single VERIFY of the prefix can't tell
+        self.assertTrue(iap.verify_data(data[:2*PAGE_SIZE]))
+        self.assertIsNone(iap.resume_burn(data, 2*PAGE_SIZE))
+
+    # ---------------------------------------------------------
+    # mux interleave
+    def test_interleave_burn(self):
+        data = firmware(5000)
+        sessions = {}
+        devices = {}
+        for channel, nack_writes in ((0, [10]), (1, [])):
+            devices[channel], sessions[channel] = self.boot_device(nack_writes=nack_writes)
+            self.assertTrue(sessions[channel].earse_flash(len(data)))
+        statuses = interleave_burn(sessions, data)
+        self.assertEqual(statuses, {0: IAP_OK, 1: IAP_OK})
+        self.assertEqual(devices[0].write_nacks, 1)
+        for device in devices.values():
+            self.assertEqual(bytes(device.flash[:len(data)]), data)
+
+    def test_fleet_progress(self):
+        # progress of every board summed into one line per 10%
+        data = firmware(5000)
+        sessions = {}
+        for channel in (0, 1):
+            _, sessions[channel] = self.boot_device()
+            self.assertTrue(sessions[channel].earse_flash(len(data)))
+        stream = io.StringIO()
+        progress = FleetProgress(sessions, ProgressLine("flash-all", stream))
+        interleave_burn(sessions, data, on_progress=progress.update)
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(lines[-1], f"flash-all: {2*len(data)}/{2*len(data)} bytes (100%)")
+        self.assertLessEqual(len(lines), 11)
+
+
+if __name__ == "__main__":
+    unittest.main()